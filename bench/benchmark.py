@@ -0,0 +1,341 @@
+'''
+Benchmarks for the bridge, run against a fake cleartool (see fakecleartool.py)
+serving a generated VOB, and local git repositories. Each scenario appends one
+JSON line with its parameters, wall time and per-command metrics to the output
+file, so that results can be compared over time.
+
+The fake cleartool is put on PATH as a shell script, so this runs on POSIX
+hosts only.
+
+    python bench/benchmark.py [--files N] [--changesets N] [--commits N] [scenario ...]
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import platform
+import optparse
+import tempfile
+import subprocess
+from datetime import datetime, timedelta
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from fakecleartool import Vob, TIME_FORMAT
+
+SCENARIOS = ['newBridge', 'togit', 'tocc', 'toccResume']
+SINCE = '01-Jan-2020'
+
+CONFIG = '''[core]
+git_root = %(git)s
+cc_root = %(view)s
+log_file = %(log)s
+include = .
+branches = main
+cc_session = %(session)s
+fetch_workers = %(workers)d
+checkin_workers = %(checkinWorkers)d
+fast_import = %(fastImport)s
+%(blobCache)s
+%(remote)s
+[email]
+smtp = localhost
+sender = bench@example.com
+recipients = bench@example.com
+'''
+
+USERS = '''def getUserName(userId):
+    return u'User %s' % userId
+
+def getUserEmail(userId):
+    return '%s@example.com' % userId
+'''
+
+
+class Workspace(object):
+    '''
+    A temporary directory with the fake VOB model, the snapshot view, the bridge
+    repository, a central repository and a developer clone.
+    '''
+    def __init__(self, options):
+        self.options = options
+        self.root = tempfile.mkdtemp(prefix='bgcc-bench-')
+        self.model = os.path.join(self.root, 'model')
+        self.view = os.path.join(self.root, 'view')
+        self.git = os.path.join(self.root, 'git')
+        self.central = os.path.join(self.root, 'central.git')
+        self.dev = os.path.join(self.root, 'dev')
+        bin = os.path.join(self.root, 'bin')
+        os.makedirs(bin)
+        shim = os.path.join(bin, 'cleartool')
+        ff = open(shim, 'w')
+        ff.write('#!/bin/sh\nexec "%s" "%s" "$@"\n' % (sys.executable, os.path.join(BENCH_DIR, 'fakecleartool.py')))
+        ff.close()
+        os.chmod(shim, 0o755)
+        ff = open(os.path.join(self.root, 'users.py'), 'w')
+        ff.write(USERS)
+        ff.close()
+        sys.path.insert(0, self.root)
+        os.environ['BGCC_FAKE_VOB'] = self.model
+        os.environ['PATH'] = bin + os.pathsep + os.environ['PATH']
+        os.environ['GIT_CONFIG_NOSYSTEM'] = '1'
+        gitconfig = [('init.defaultBranch', 'master'), ('user.name', 'Bench'), ('user.email', 'bench@example.com')]
+        os.environ['GIT_CONFIG_COUNT'] = str(len(gitconfig))
+        for ii, (key, value) in enumerate(gitconfig):
+            os.environ['GIT_CONFIG_KEY_%d' % ii] = key
+            os.environ['GIT_CONFIG_VALUE_%d' % ii] = value
+        logger = logging.getLogger('log.bgcc.file')
+        handler = logging.FileHandler(os.path.join(self.root, 'bgcc.log'))
+        handler.setFormatter(logging.Formatter('%(asctime)s [%(module)s.%(funcName)s] %(message)s'))
+        logger.addHandler(handler)
+        logger.setLevel(logging.DEBUG)
+
+    def config(self, remote=False):
+        import util
+        path = os.path.join(self.root, 'bgcc.conf')
+        ff = open(path, 'w')
+        ff.write(CONFIG % {
+            'git': self.git,
+            'view': self.view,
+            'log': os.path.join(self.root, 'bgcc.log'),
+            'session': str(self.options.session).lower(),
+            'workers': self.options.workers,
+            'checkinWorkers': self.options.checkinWorkers,
+            'fastImport': str(self.options.fastImport).lower(),
+            'remote': 'remote = remotes/central/master' if remote else '',
+            'blobCache': 'blob_cache = %s\nblob_cache_scope = bench' % self.options.blobCache if self.options.blobCache else '',
+        })
+        ff.close()
+        return util.GitConfigParser(path)
+
+    def close(self):
+        if self.options.keep:
+            print 'Workspace kept at %s' % self.root
+        else:
+            shutil.rmtree(self.root, ignore_errors=True)
+
+
+def git(cwd, *args):
+    return subprocess.check_output(('git',) + args, cwd=cwd, stderr=subprocess.STDOUT)
+
+
+def newBridge(ws, options):
+    import bridge
+    Vob.create(ws.model, ws.view, options.files, options.fanout, options.size)
+    bb = bridge.GitCCBridge(ws.config())
+    try:
+        bb.newBridge(SINCE)
+    finally:
+        bb.close()
+
+
+def externalChangesets(ws, options):
+    '''
+    Check in options.changesets changesets from other views, each touching
+    options.filesPerChangeset files and every fifth one adding a file, and
+    from the second of those on removing the one added before.
+    '''
+    vob = Vob(ws.model)
+    clock = datetime.strptime(SINCE, '%d-%b-%Y') + timedelta(days=1)
+    for ii in range(options.changesets):
+        user = 'user%d' % (ii % 3)
+        comment = 'Changeset %d' % ii
+        for jj in range(options.filesPerChangeset):
+            path = Vob.syntheticPath((ii * options.filesPerChangeset + jj) % options.files, options.fanout)
+            clock += timedelta(seconds=1)
+            vob.externalCheckin(path, 'changeset %d, file %d\n' % (ii, jj) * 50, user, comment, clock.strftime(TIME_FORMAT))
+        if ii % 5 == 0:
+            clock += timedelta(seconds=1)
+            vob.externalCheckin('added/a%05d.c' % ii, 'added in changeset %d\n' % ii, user, comment, clock.strftime(TIME_FORMAT))
+            if ii > 0:
+                clock += timedelta(seconds=1)
+                vob.externalRemove('added/a%05d.c' % (ii - 5), user, clock.strftime(TIME_FORMAT))
+        clock += timedelta(minutes=1)
+    vob.save()
+
+
+def developerCommits(ws, options):
+    '''
+    Publish the bridge repository to a central repository, and push
+    options.commits commits to it from a developer clone.
+    '''
+    git(ws.root, 'init', '--bare', '-q', ws.central)
+    git(ws.git, 'remote', 'add', 'central', ws.central)
+    git(ws.git, 'push', '-q', 'central', 'master')
+    git(ws.git, 'fetch', '-q', 'central')
+    git(ws.git, 'branch', '--set-upstream-to=central/master', 'master')
+    git(ws.root, 'clone', '-q', ws.central, ws.dev)
+    for ii in range(options.commits):
+        path = Vob.syntheticPath((ii * 7) % options.files, options.fanout)
+        if ii % 5 == 4:
+            path = 'new%02d/n%05d.c' % (ii % 3, ii)
+            if not os.path.exists(os.path.join(ws.dev, os.path.dirname(path))):
+                os.makedirs(os.path.join(ws.dev, os.path.dirname(path)))
+        ff = open(os.path.join(ws.dev, path), 'a')
+        ff.write('developer change %d\n' % ii)
+        ff.close()
+        git(ws.dev, 'add', path)
+        git(ws.dev, 'commit', '-q', '-m', 'Developer commit %d' % ii)
+    git(ws.dev, 'push', '-q', 'origin', 'master')
+
+
+def interruptedCheckins(ws, options):
+    '''
+    Push a commit that moves, removes and adds files, and make two bridge runs fail
+    half way: one while the first new file element is created, and one while the
+    elements of that last commit are checked in, after their directories.
+    '''
+    import bridge
+    for dir in ('moved', 'late'):
+        os.makedirs(os.path.join(ws.dev, dir))
+    git(ws.dev, 'mv', Vob.syntheticPath(1, options.fanout), 'moved/m00001.c')
+    git(ws.dev, 'rm', '-q', Vob.syntheticPath(2, options.fanout))
+    ff = open(os.path.join(ws.dev, 'late', 'l00000.c'), 'w')
+    ff.write('added late\n')
+    ff.close()
+    git(ws.dev, 'add', 'late/l00000.c')
+    git(ws.dev, 'commit', '-q', '-m', 'Move, remove and add')
+    git(ws.dev, 'push', '-q', 'origin', 'master')
+    def failAdd(file):
+        raise Exception('Interrupted creating %s' % file)
+    def failCheckin(files, comment):
+        if comment != 'Move, remove and add':
+            return checkinFiles(files, comment)
+        checkinFiles([ff for ff in files if os.path.isdir(os.path.join(ws.view, ff))], comment)
+        raise Exception('Interrupted checking in %s' % comment)
+    for method, replacement in [('addFile', failAdd), ('checkinFiles', failCheckin)]:
+        bb = bridge.GitCCBridge(ws.config(remote=True))
+        checkinFiles = bridge.cc.checkinFiles
+        setattr(bridge.cc, method, replacement)
+        try:
+            bb.onDoCheckinToClearcase()
+            raise Exception('The checkin was not interrupted')
+        except bridge.UpdateCCAreaException:
+            pass
+        except Exception as e:
+            if not str(e).startswith('Interrupted'):
+                raise
+        finally:
+            bb.close()
+
+
+def checkClearcase(ws):
+    '''
+    Raise if the VOB does not have the files of master, or has elements checked out.
+    '''
+    vob = Vob(ws.model)
+    checkedout = [path for path, element in vob.elements.items() if element['checkedout']]
+    if checkedout:
+        raise Exception('Elements left checked out: %s' % ', '.join(sorted(checkedout)))
+    files = git(ws.git, 'ls-tree', '-r', '--name-only', 'master').split()
+    elements = [path for path, element in vob.elements.items() if element['type'] == 'file']
+    if sorted(files) != sorted(elements):
+        raise Exception('Files differ between master and the VOB: %s' % ', '.join(sorted(set(files) ^ set(elements))))
+    for file in files:
+        if vob._blob(vob.elements[file]['versions'][-1]) != git(ws.git, 'show', 'master:' + file):
+            raise Exception('Contents differ between master and the VOB: %s' % file)
+
+
+def run(scenario, options):
+    ws = Workspace(options)
+    # The bridge needs the users module written to the workspace
+    import bridge
+    import metrics
+    try:
+        if scenario == 'newBridge':
+            metrics.reset()
+            start = time.time()
+            newBridge(ws, options)
+            seconds = time.time() - start
+        elif scenario == 'togit':
+            newBridge(ws, options)
+            externalChangesets(ws, options)
+            metrics.reset()
+            start = time.time()
+            bb = bridge.GitCCBridge(ws.config())
+            try:
+                if bridge.isPendingClearcaseChanges():
+                    bb.onNewClearcaseChanges()
+            finally:
+                bb.close()
+            seconds = time.time() - start
+        elif scenario in ('tocc', 'toccResume'):
+            newBridge(ws, options)
+            developerCommits(ws, options)
+            if scenario == 'toccResume':
+                interruptedCheckins(ws, options)
+            metrics.reset()
+            start = time.time()
+            bb = bridge.GitCCBridge(ws.config(remote=True))
+            try:
+                bb.onDoCheckinToClearcase()
+            finally:
+                bb.close()
+            seconds = time.time() - start
+            if scenario == 'toccResume':
+                checkClearcase(ws)
+        else:
+            raise Exception('Unknown scenario: %s' % scenario)
+        return {
+            'scenario': scenario,
+            'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'host': platform.node(),
+            'python': platform.python_version(),
+            'git': git(ws.root, '--version').strip(),
+            'revision': revision(),
+            'params': {
+                'files': options.files,
+                'fanout': options.fanout,
+                'size': options.size,
+                'changesets': options.changesets if scenario == 'togit' else None,
+                'files_per_changeset': options.filesPerChangeset if scenario == 'togit' else None,
+                'commits': options.commits if scenario in ('tocc', 'toccResume') else None,
+                'session': options.session,
+                'workers': options.workers,
+                'checkin_workers': options.checkinWorkers,
+                'fast_import': options.fastImport,
+                'blob_cache': options.blobCache is not None,
+            },
+            'seconds': seconds,
+            'commands': metrics.snapshot(),
+        }
+    finally:
+        ws.close()
+
+
+def revision():
+    try:
+        return git(os.path.dirname(BENCH_DIR), 'rev-parse', 'HEAD').strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] [' + '|'.join(SCENARIOS) + ' ...]')
+    parser.add_option('--files', type='int', default=1000, help='Number of file elements in the generated VOB')
+    parser.add_option('--fanout', type='int', default=20, help='Maximum number of entries per generated directory')
+    parser.add_option('--size', type='int', default=2048, help='Size in bytes of the generated files')
+    parser.add_option('--changesets', type='int', default=50, help='Number of changesets for the togit scenario')
+    parser.add_option('--files-per-changeset', type='int', default=5, dest='filesPerChangeset')
+    parser.add_option('--commits', type='int', default=50, help='Number of commits for the tocc scenario')
+    parser.add_option('--session', action='store_true', default=False, help='Use an interactive cleartool session')
+    parser.add_option('--workers', type='int', default=4, help='Number of VOB fetch workers')
+    parser.add_option('--checkin-workers', type='int', default=1, dest='checkinWorkers', help='Number of concurrent checkin processes')
+    parser.add_option('--fast-import', action='store_true', default=False, dest='fastImport')
+    parser.add_option('--blob-cache', metavar='DIR', dest='blobCache', help='Blob cache directory, kept between runs')
+    parser.add_option('-o', '--output', default='bench_output.jsonl', help='File to append results to, one JSON object per line')
+    parser.add_option('--keep', action='store_true', default=False, help='Keep the workspaces for inspection')
+    options, args = parser.parse_args()
+    for scenario in args or SCENARIOS:
+        result = run(scenario, options)
+        ff = open(options.output, 'a')
+        ff.write(json.dumps(result, sort_keys=True) + '\n')
+        ff.close()
+        print '%-10s %8.2f s  %d commands' % (scenario, result['seconds'], sum([cc['count'] for cc in result['commands'].values()]))
+
+
+if __name__ == '__main__':
+    main()
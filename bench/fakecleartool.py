@@ -0,0 +1,501 @@
+'''
+A local stand-in for cleartool, serving the commands the bridge uses from a
+synthetic VOB model kept on disk. The model directory is given by the
+BGCC_FAKE_VOB environment variable, and the snapshot view is the directory
+recorded in the model when it was generated.
+
+Only the one branch 'main' is modelled. Versions loaded in the view are
+tracked per element, so checkins made "elsewhere" (see Vob.externalCheckin)
+only reach the view on update, as in a real snapshot view.
+'''
+import os
+import sys
+import json
+import fcntl
+import shlex
+import shutil
+import hashlib
+from datetime import datetime, timedelta
+
+TIME_FORMAT = '%Y%m%d.%H%M%S'
+BRANCH = '/main'
+# Commands that change the model; the others may run concurrently
+MUTATING = ['co', 'ci', 'unco', 'mkelem', 'rm', 'mv', 'update']
+
+
+class CleartoolError(Exception):
+    pass
+
+
+class Vob(object):
+    def __init__(self, root):
+        self.root = root
+        ff = open(os.path.join(root, 'state.json'), 'r')
+        self.inode = os.fstat(ff.fileno()).st_ino
+        self.state = json.load(ff)
+        ff.close()
+        self.view = self.state['view']
+        self.elements = self.state['elements']
+        self.events = self.state['events']
+
+    @staticmethod
+    def create(root, view, files, fanout=10, size=2048, time='20190101.000000'):
+        '''
+        Generate a model with the given number of file elements, spread over
+        directories with at most fanout entries, all loaded in the view.
+        '''
+        for dir in (root, os.path.join(root, 'data'), view):
+            if not os.path.exists(dir):
+                os.makedirs(dir)
+        state = {'view': os.path.abspath(view), 'clock': time, 'elements': {}, 'events': []}
+        ff = open(os.path.join(root, 'state.json'), 'w')
+        json.dump(state, ff)
+        ff.close()
+        vob = Vob(root)
+        vob._addElement('.', 'directory', None)
+        for ii in range(files):
+            path = vob.syntheticPath(ii, fanout)
+            vob._ensureDirectory(os.path.dirname(path))
+            vob._addElement(path, 'file', vob._content(path, 1, size))
+        for path, element in vob.elements.items():
+            element['loaded'] = len(element['versions']) - 1
+            vob._load(path)
+        vob.save()
+        return vob
+
+    @staticmethod
+    def syntheticPath(ii, fanout):
+        parts = []
+        nn = ii // fanout
+        while nn > 0:
+            parts.insert(0, 'd%02d' % (nn % fanout))
+            nn = nn // fanout
+        return '/'.join(parts + ['f%05d.c' % ii])
+
+    def save(self):
+        tmp = os.path.join(self.root, 'state.json.%d' % os.getpid())
+        ff = open(tmp, 'w')
+        json.dump(self.state, ff)
+        ff.close()
+        os.rename(tmp, os.path.join(self.root, 'state.json'))
+        self.inode = os.stat(os.path.join(self.root, 'state.json')).st_ino
+
+    def lock(self):
+        '''
+        Lock the model against other cleartool processes until the returned file is closed.
+        '''
+        ff = open(os.path.join(self.root, 'lock'), 'w')
+        fcntl.flock(ff, fcntl.LOCK_EX)
+        return ff
+
+    def refresh(self):
+        '''
+        Reload the model if another process has saved it since.
+        '''
+        if os.stat(os.path.join(self.root, 'state.json')).st_ino != self.inode:
+            self.__init__(self.root)
+
+    def externalCheckin(self, path, content, user, comment, time):
+        '''
+        Check in a new version of a file element from another view, creating the
+        element (and its directories) if needed.
+        '''
+        self.state['clock'] = time
+        if path not in self.elements:
+            self._ensureDirectory(os.path.dirname(path) or '.', user, time)
+            self._addElement(path, 'file', None)
+            self._checkinDirectory(os.path.dirname(path) or '.', user, 'Added file element "%s".' % os.path.basename(path), time)
+        element = self.elements[path]
+        element['versions'].append(self._store(content))
+        self._event('version', user, path, len(element['versions']) - 1, comment, time)
+
+    def externalRemove(self, path, user, time):
+        '''
+        Remove the name of an element from its directory (rmname) from another view.
+        The file stays in the view until the directory is updated, and its versions
+        can still be fetched.
+        '''
+        self.state['clock'] = time
+        self.state.setdefault('removed', {})[path] = self.elements.pop(path)
+        dir = os.path.dirname(path) or '.'
+        self.elements[dir].setdefault('uncataloged', []).append(os.path.basename(path))
+        self._checkinDirectory(dir, user, 'Uncataloged file element "%s".' % os.path.basename(path), time)
+
+    def externalMove(self, src, dst, user, time):
+        '''
+        Move an element (mv) from another view. The file stays at src in the view
+        until its directory is updated, and shows at dst once that one is.
+        '''
+        self.state['clock'] = time
+        self.elements[dst] = self.elements.pop(src)
+        dir = os.path.dirname(src) or '.'
+        self.elements[dir].setdefault('uncataloged', []).append(os.path.basename(src))
+        self._checkinDirectory(dir, user, 'Uncataloged file element "%s".' % os.path.basename(src), time)
+        dir = os.path.dirname(dst) or '.'
+        self._ensureDirectory(dir, user, time)
+        self.elements[dir].setdefault('cataloged', []).append(os.path.basename(dst))
+        self._checkinDirectory(dir, user, 'Cataloged file element "%s".' % os.path.basename(dst), time)
+
+    def _content(self, path, version, size):
+        seed = '%s@@%s/%d\n' % (path, BRANCH, version)
+        return self._store((seed * (size // len(seed) + 1))[:size])
+
+    def _store(self, content):
+        sha = hashlib.sha1(content).hexdigest()
+        blob = os.path.join(self.root, 'data', sha)
+        if not os.path.exists(blob):
+            ff = open(blob, 'wb')
+            ff.write(content)
+            ff.close()
+        return sha
+
+    def _blob(self, sha):
+        ff = open(os.path.join(self.root, 'data', sha), 'rb')
+        content = ff.read()
+        ff.close()
+        return content
+
+    def _addElement(self, path, type, sha):
+        self.elements[path] = {'type': type, 'versions': [None, sha] if type == 'file' else [None, None], 'loaded': None, 'checkedout': False, 'pending': []}
+
+    def _ensureDirectory(self, dir, user=None, time=None):
+        if dir in ('', '.') or dir in self.elements:
+            return
+        parent = os.path.dirname(dir) or '.'
+        self._ensureDirectory(parent, user, time)
+        self._addElement(dir, 'directory', None)
+        if user:
+            self._checkinDirectory(parent, user, 'Added directory element "%s".' % os.path.basename(dir), time)
+
+    def _unload(self, path):
+        target = os.path.join(self.view, path)
+        if os.path.isdir(target):
+            shutil.rmtree(target)
+        elif os.path.exists(target):
+            os.chmod(target, 0o644)
+            os.remove(target)
+
+    def _checkinDirectory(self, dir, user, comment, time):
+        element = self.elements[dir]
+        element['versions'].append(None)
+        self._event('directory version', user, dir, len(element['versions']) - 1, comment, time)
+
+    def _event(self, kind, user, path, version, comment, time):
+        self.events.append({'kind': kind, 'user': user, 'file': path, 'version': '%s/%d' % (BRANCH, version), 'comment': comment, 'time': time})
+
+    def _tick(self):
+        clock = datetime.strptime(self.state['clock'], TIME_FORMAT) + timedelta(seconds=1)
+        self.state['clock'] = clock.strftime(TIME_FORMAT)
+        return self.state['clock']
+
+    def _load(self, path):
+        element = self.elements[path]
+        target = os.path.join(self.view, path)
+        if element['type'] == 'directory':
+            if not os.path.isdir(target):
+                os.makedirs(target)
+            return
+        parent = os.path.dirname(target)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        if os.path.exists(target):
+            os.chmod(target, 0o644)
+        ff = open(target, 'wb')
+        ff.write(self._blob(element['versions'][element['loaded']]))
+        ff.close()
+        os.chmod(target, 0o444)
+
+
+class Cleartool(object):
+    '''
+    Executes cleartool command lines against a Vob, writing output like cleartool.
+    '''
+    def __init__(self, vob, cwd, out=sys.stdout, err=sys.stderr):
+        self.vob = vob
+        self.cwd = cwd
+        self.out = out
+        self.err = err
+
+    def run(self, args):
+        '''
+        Run one command and return its exit status.
+        '''
+        if not args:
+            return 0
+        handler = getattr(self, 'cmd_%s' % args[0], None)
+        if handler is None:
+            self.err.write('cleartool: Error: Unrecognized command: "%s"\n' % args[0])
+            return 1
+        self.failed = False
+        # Mutating commands may run from several processes at once, e.g. concurrent checkins
+        lock = self.vob.lock() if args[0] in MUTATING else None
+        try:
+            self.vob.refresh()
+            try:
+                handler(args[1:])
+            except CleartoolError as e:
+                self.err.write('cleartool: Error: %s\n' % e)
+                self.failed = True
+            if lock:
+                self.vob.save()
+        finally:
+            if lock:
+                lock.close()
+        return 1 if self.failed else 0
+
+    def interactive(self, stdin):
+        count = 0
+        for line in iter(stdin.readline, ''):
+            args = shlex.split(line)
+            if args and args[0] in ('quit', 'exit'):
+                break
+            count += 1
+            status = self.run(args)
+            self.out.write('Command %d returned status %d\n' % (count, status))
+            self.out.flush()
+
+    def _element(self, pname):
+        path = os.path.relpath(os.path.abspath(os.path.join(self.cwd, pname)), self.vob.view)
+        return path.replace(os.sep, '/')
+
+    def _each(self, pnames, fn):
+        for pname in pnames:
+            try:
+                fn(pname, self._element(pname))
+            except CleartoolError as e:
+                self.err.write('cleartool: Error: %s\n' % e)
+                self.failed = True
+
+    def _options(self, args, flags, valued):
+        options = {}
+        rest = []
+        ii = 0
+        while ii < len(args):
+            if args[ii] in valued:
+                options[args[ii]] = args[ii + 1]
+                ii += 2
+                continue
+            if args[ii] in flags:
+                options[args[ii]] = True
+            else:
+                rest.append(args[ii])
+            ii += 1
+        return options, rest
+
+    def _below(self, path, scopes):
+        for scope in scopes:
+            if scope == '.' or path == scope or path.startswith(scope + '/'):
+                return True
+        return False
+
+    def cmd_lsh(self, args):
+        options, pnames = self._options(args, ['-recurse'], ['-fmt', '-since'])
+        scopes = [self._element(pp) for pp in pnames] or ['.']
+        since = datetime.strptime(options['-since'], '%d-%b-%Y.%H:%M:%S').strftime(TIME_FORMAT) if '-since' in options else ''
+        fmt = options.get('-fmt', '%Nd %u %o%m "%En@@%Vn"\n')
+        for ii, event in reversed(list(enumerate(self.vob.events))):
+            if event['time'] < since or not self._below(event['file'], scopes):
+                continue
+            line = fmt
+            for token, value in [('%On', 'oid.%08d' % ii), ('%Nd', event['time']), ('%En', event['file']), ('%Vn', event['version']), ('%Nc', event['comment']), ('%o', 'checkin'), ('%m', event['kind']), ('%u', event['user'])]:
+                line = line.replace(token, value)
+            self.out.write(line)
+
+    def cmd_ls(self, args):
+        options, pnames = self._options(args, ['-long', '-recurse', '-vob'], [])
+        scopes = [self._element(pp) for pp in pnames] or ['.']
+        for path in sorted(self.vob.elements):
+            element = self.vob.elements[path]
+            if element['type'] != 'file' or element['loaded'] is None or not self._below(path, scopes):
+                continue
+            # Only what is loaded in the view, like in a snapshot view
+            if not os.path.exists(os.path.join(self.vob.view, path)):
+                continue
+            self.out.write('version                %s@@%s/%d                     Rule: element * %s/LATEST\n' % (path, BRANCH, element['loaded'], BRANCH))
+
+    def cmd_lsco(self, args):
+        options, pnames = self._options(args, ['-cview', '-short', '-recurse', '-me'], [])
+        scopes = [self._element(pp) for pp in pnames] or ['.']
+        for path in sorted(self.vob.elements):
+            if self.vob.elements[path]['checkedout'] and self._below(path, scopes):
+                self.out.write('%s\n' % path)
+
+    def cmd_get(self, args):
+        options, pnames = self._options(args, [], ['-to'])
+        element, version = pnames[0].split('@@')
+        path = self._element(element)
+        found = self.vob.elements.get(path) or self.vob.state.get('removed', {}).get(path)
+        if found is None:
+            raise CleartoolError('Pathname not found: "%s".' % element)
+        number = int(version.split('/')[-1])
+        versions = found['versions']
+        if number >= len(versions) or versions[number] is None:
+            raise CleartoolError('Version not found: "%s".' % pnames[0])
+        dest = os.path.join(self.cwd, options['-to'])
+        ff = open(dest, 'wb')
+        ff.write(self.vob._blob(versions[number]))
+        ff.close()
+        os.chmod(dest, 0o444)
+
+    def cmd_co(self, args):
+        options, pnames = self._options(args, ['-reserved', '-unreserved', '-nc'], ['-c'])
+        def co(pname, path):
+            element = self.vob.elements.get(path)
+            if element is None:
+                raise CleartoolError('Pathname not found: "%s".' % pname)
+            if element['checkedout']:
+                raise CleartoolError('Element "%s" is already checked out to view "bench".' % pname)
+            element['checkedout'] = True
+            element['loaded'] = len(element['versions']) - 1
+            self.vob._load(path)
+            if element['type'] == 'file':
+                os.chmod(os.path.join(self.vob.view, path), 0o644)
+            self.out.write('Checked out "%s" from version "%s/%d".\n' % (pname, BRANCH, element['loaded']))
+        self._each(pnames, co)
+
+    def cmd_ci(self, args):
+        options, pnames = self._options(args, ['-identical', '-nc'], ['-c', '-cfile'])
+        comment = options.get('-c', '')
+        if '-cfile' in options:
+            ff = open(os.path.join(self.cwd, options['-cfile']), 'r')
+            comment = ff.read()
+            ff.close()
+        def ci(pname, path):
+            element = self.vob.elements.get(path)
+            if element is None or not element['checkedout']:
+                raise CleartoolError('Unable to find checked out version for "%s".' % pname)
+            time = self.vob._tick()
+            if element['type'] == 'file':
+                ff = open(os.path.join(self.vob.view, path), 'rb')
+                element['versions'].append(self.vob._store(ff.read()))
+                ff.close()
+                os.chmod(os.path.join(self.vob.view, path), 0o444)
+                self.vob._event('version', 'bench', path, len(element['versions']) - 1, comment, time)
+            else:
+                for pending in element['pending'] or [comment]:
+                    element['versions'].append(None)
+                    self.vob._event('directory version', 'bench', path, len(element['versions']) - 1, pending, time)
+                element['pending'] = []
+            element['checkedout'] = False
+            element['loaded'] = len(element['versions']) - 1
+            self.out.write('Checked in "%s" version "%s/%d".\n' % (pname, BRANCH, element['loaded']))
+        self._each(pnames, ci)
+
+    def cmd_unco(self, args):
+        options, pnames = self._options(args, ['-rm', '-keep'], [])
+        def unco(pname, path):
+            element = self.vob.elements.get(path)
+            if element is None or not element['checkedout']:
+                raise CleartoolError('Element "%s" is not checked out.' % pname)
+            element['checkedout'] = False
+            element['pending'] = []
+            if len(element['versions']) == 2 and element['versions'][1] is None and element['type'] == 'file':
+                del self.vob.elements[path] # uncheckout of a new element
+                return
+            self.vob._load(path)
+            self.out.write('Checkout cancelled for "%s".\n' % pname)
+        self._each(pnames, unco)
+
+    def _parentCheckedOut(self, pname, path):
+        parent = os.path.dirname(path) or '.'
+        if parent not in self.vob.elements or not self.vob.elements[parent]['checkedout']:
+            raise CleartoolError('Can\'t modify directory "%s" because it is not checked out.' % (os.path.dirname(pname) or '.'))
+        return self.vob.elements[parent]
+
+    def cmd_mkelem(self, args):
+        options, pnames = self._options(args, ['-nc', '-mkpath'], ['-eltype', '-c'])
+        type = 'directory' if options.get('-eltype') == 'directory' else 'file'
+        def mkelem(pname, path):
+            if path in self.vob.elements:
+                raise CleartoolError('Entry named "%s" already exists.' % pname)
+            parent = self._parentCheckedOut(pname, path)
+            self.vob._addElement(path, type, None)
+            element = self.vob.elements[path]
+            element['loaded'] = 1
+            element['checkedout'] = True
+            if type == 'file':
+                target = os.path.join(self.vob.view, path)
+                if not os.path.exists(target):
+                    open(target, 'wb').close()
+                element['versions'][1] = self.vob._store('')
+            else:
+                self.vob._load(path)
+            parent['pending'].append('Added %s element "%s".' % (type, os.path.basename(path)))
+            self.out.write('Created element "%s" (type "%s").\n' % (pname, type))
+        self._each(pnames, mkelem)
+
+    def cmd_rm(self, args):
+        options, pnames = self._options(args, ['-nc', '-force'], ['-c'])
+        def rm(pname, path):
+            if path not in self.vob.elements:
+                raise CleartoolError('Pathname not found: "%s".' % pname)
+            parent = self._parentCheckedOut(pname, path)
+            for other in [pp for pp in self.vob.elements if pp == path or pp.startswith(path + '/')]:
+                del self.vob.elements[other]
+            target = os.path.join(self.vob.view, path)
+            if os.path.isdir(target):
+                shutil.rmtree(target)
+            elif os.path.exists(target):
+                os.chmod(target, 0o644)
+                os.remove(target)
+            parent['pending'].append('Uncataloged file element "%s".' % os.path.basename(path))
+            self.out.write('Removed "%s".\n' % pname)
+        self._each(pnames, rm)
+
+    def cmd_mv(self, args):
+        options, pnames = self._options(args, ['-nc'], ['-c'])
+        src, dst = self._element(pnames[0]), self._element(pnames[1])
+        if src not in self.vob.elements:
+            raise CleartoolError('Pathname not found: "%s".' % pnames[0])
+        source = self._parentCheckedOut(pnames[0], src)
+        target = self._parentCheckedOut(pnames[1], dst)
+        for other in [pp for pp in self.vob.elements if pp == src or pp.startswith(src + '/')]:
+            self.vob.elements[dst + other[len(src):]] = self.vob.elements.pop(other)
+        os.rename(os.path.join(self.vob.view, src), os.path.join(self.vob.view, dst))
+        source['pending'].append('Uncataloged file element "%s".' % os.path.basename(src))
+        target['pending'].append('Cataloged file element "%s".' % os.path.basename(dst))
+        self.out.write('Moved "%s" to "%s".\n' % (pnames[0], pnames[1]))
+
+    def cmd_update(self, args):
+        options, pnames = self._options(args, ['-print', '-ove', '-overwrite', '-force'], ['-log'])
+        scopes = [self._element(pp) for pp in pnames] or ['.']
+        lines = []
+        for path in sorted(self.vob.elements):
+            element = self.vob.elements[path]
+            latest = len(element['versions']) - 1
+            if not self._below(path, scopes) or element['checkedout'] or element['loaded'] == latest:
+                continue
+            lines.append('Updated: "%s" to version "%s/%d".' % (path, BRANCH, latest))
+            if '-print' not in options:
+                element['loaded'] = latest
+                self.vob._load(path)
+                for name in element.pop('uncataloged', []):
+                    self.vob._unload(os.path.join(path, name))
+                for name in element.pop('cataloged', []):
+                    self.vob._load(os.path.join(path, name))
+        log = '\n'.join(lines) + '\n'
+        if '-log' in options:
+            ff = open(os.path.join(self.cwd, options['-log']), 'w')
+            ff.write(log)
+            ff.close()
+        self.out.write(log)
+
+    def cmd_catcs(self, args):
+        self.out.write('element * CHECKEDOUT\nelement * %s/LATEST\n' % BRANCH)
+
+    def cmd_setcs(self, args):
+        pass
+
+
+def main():
+    vob = Vob(os.environ['BGCC_FAKE_VOB'])
+    tool = Cleartool(vob, os.getcwd())
+    args = sys.argv[1:]
+    if args == ['-status'] or args == []:
+        tool.interactive(sys.stdin)
+        return 0
+    return tool.run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
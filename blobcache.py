@@ -0,0 +1,155 @@
+'''
+Content-addressed cache of element versions fetched from clearcase. The first
+'cleartool get' of a version stores its contents under the git blob sha of the
+contents, and records the sha for the version. Later fetches of the same version
+are served from the cache, and the known sha lets the version be staged in git
+without hashing it again.
+
+The cache is a directory that several bridges on the same host may share:
+contents are written atomically and never change, and the version table is an
+SQLite database. Versions are recorded per scope, since file@@version is relative
+to the view root; bridges whose cc_root is the same VOB directory, in different
+views, share versions by configuring the same scope. The least recently used
+contents are evicted when the cache grows beyond its size limit. The permission
+bits of a version are recorded with it and restored on the copies.
+'''
+import os
+import stat
+import time
+import shutil
+import sqlite3
+import hashlib
+import threading
+import logging
+
+logger = logging.getLogger('log.bgcc.file')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS versions (
+    scope TEXT NOT NULL,
+    ccfile TEXT NOT NULL,
+    sha TEXT NOT NULL,
+    mode INTEGER,
+    PRIMARY KEY (scope, ccfile)
+);
+CREATE TABLE IF NOT EXISTS blobs (
+    sha TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    used REAL NOT NULL
+);
+'''
+
+# Check the cache size every so many stored versions
+EVICT_INTERVAL = 100
+
+
+def blobSha(data):
+    '''
+    The sha git gives a blob with the given contents.
+    '''
+    return hashlib.sha1('blob %d\0%s' % (len(data), data)).hexdigest()
+
+
+class BlobCache(object):
+    def __init__(self, dir, scope, megabytes=1024):
+        self.dir = dir
+        self.scope = scope
+        self.limit = megabytes * 1024 * 1024
+        self.lock = threading.Lock()
+        self.stored = 0
+        if not os.path.exists(dir):
+            os.makedirs(dir)
+        self.db = sqlite3.connect(os.path.join(dir, 'cache.db'), timeout=60, check_same_thread=False)
+        self.db.text_factory = str
+        self.db.executescript(SCHEMA)
+        # Caches created before the mode was recorded
+        if 'mode' not in [row[1] for row in self.db.execute('PRAGMA table_info(versions)')]:
+            self.db.execute('ALTER TABLE versions ADD COLUMN mode INTEGER')
+
+    def get(self, ccfile, dest):
+        '''
+        Copy the cached contents of ccfile to dest, with the mode it was stored with.
+        Return the blob sha, or None if the version is not cached.
+        '''
+        with self.lock:
+            row = self.db.execute('SELECT sha, mode FROM versions WHERE scope = ? AND ccfile = ?', (self.scope, ccfile)).fetchone()
+        if row is None or row[1] is None:
+            return None
+        sha, mode = row
+        try:
+            shutil.copyfile(self._path(sha), dest)
+            os.chmod(dest, mode)
+        except (IOError, OSError):
+            # Evicted by another bridge in the meantime
+            return None
+        with self.lock:
+            with self.db:
+                self.db.execute('UPDATE blobs SET used = ? WHERE sha = ?', (time.time(), sha))
+        return sha
+
+    def put(self, ccfile, src):
+        '''
+        Store the contents and the mode of the file src as the version ccfile and
+        return its blob sha.
+        '''
+        mode = stat.S_IMODE(os.stat(src).st_mode)
+        ff = open(src, 'rb')
+        data = ff.read()
+        ff.close()
+        sha = blobSha(data)
+        path = self._path(sha)
+        if not os.path.exists(path):
+            if not os.path.exists(os.path.dirname(path)):
+                try:
+                    os.makedirs(os.path.dirname(path))
+                except OSError:
+                    pass
+            tmp = '%s.%d.%s' % (path, os.getpid(), threading.current_thread().ident)
+            ff = open(tmp, 'wb')
+            ff.write(data)
+            ff.close()
+            try:
+                os.rename(tmp, path)
+            except OSError:
+                # Stored by another bridge in the meantime (rename does not replace on Windows)
+                os.remove(tmp)
+        with self.lock:
+            with self.db:
+                self.db.execute('INSERT OR REPLACE INTO blobs (sha, size, used) VALUES (?, ?, ?)', (sha, len(data), time.time()))
+                self.db.execute('INSERT OR REPLACE INTO versions (scope, ccfile, sha, mode) VALUES (?, ?, ?, ?)', (self.scope, ccfile, sha, mode))
+            self.stored += 1
+            if self.stored % EVICT_INTERVAL == 0:
+                self._evict()
+        return sha
+
+    def close(self):
+        with self.lock:
+            self._evict()
+            self.db.close()
+
+    def _evict(self):
+        '''
+        Remove the least recently used contents until the cache is below 90% of its limit.
+        '''
+        size = self.db.execute('SELECT sum(size) FROM blobs').fetchone()[0] or 0
+        if size <= self.limit:
+            return
+        evicted = []
+        for sha, blobSize in self.db.execute('SELECT sha, size FROM blobs ORDER BY used'):
+            if size <= self.limit * 0.9:
+                break
+            evicted.append(sha)
+            size -= blobSize
+        with self.db:
+            for sha in evicted:
+                self.db.execute('DELETE FROM versions WHERE sha = ?', (sha,))
+                self.db.execute('DELETE FROM blobs WHERE sha = ?', (sha,))
+        for sha in evicted:
+            try:
+                os.remove(self._path(sha))
+            except OSError:
+                pass
+        logger.info('Evicted %d versions from the blob cache', len(evicted))
+
+    def _path(self, sha):
+        return os.path.join(self.dir, sha[:2], sha[2:])
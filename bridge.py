@@ -1,15 +1,19 @@
-import os, stat
+import os, stat, sys
 import re
 import tempfile
 from os.path import join, exists, dirname
 from datetime import datetime, timedelta
 import logging
 import traceback
+from collections import OrderedDict
 
 import users
 from git import GitFacade
-from clearcase import ClearcaseFacade
+from clearcase import ClearcaseFacade, VobFetcher, VersionIndex, Watermark
+from state import BridgeState, MERGED, CHECKINGIN, CHECKEDIN
+from blobcache import BlobCache
 import util
+import timeline
 
 
 logger = logging.getLogger('log.bgcc.file')
@@ -18,33 +22,50 @@ logger = logging.getLogger('log.bgcc.file')
 ## Branch names
 CC_BRANCH = 'master_cc'
 MASTER = 'master'
-# The CI_TAG tag is set at the commit most recently successfully checked in to clearcase,
-# and is removed when no pending commit needs to be checked in.
-# Thus, one should never see the tag unless something has gone wrong.
-CI_TAG = 'master_ci'
 
 # GIT_DIR = util.cfg.gitRoot() # 'c:/Development/gitcc-bridges/prime/br_main_electronic_trading_test/fmarket'
 # CC_DIR =  util.cfg.ccRoot() # 'c:/Development/gitcc-bridges/prime/br_main_electronic_trading_test/view/base/TM_FObject/Financial/FMarket'
 # CENTRAL = util.cfg.remote()
 
 
+# Pending commits and checkin progress, see state.BridgeState. Older versions of
+# the bridge kept the pending commits in COMMIT_CACHE, which is taken over once.
+STATE_DB = 'bgcc_state.db'
 COMMIT_CACHE = 'commit_cache'
+VOB_INDEX = 'vob_index'
+FETCH_AREA = 'vobfetch'
 
 git_excludes = []
 
-cc = git = None
+cc = git = fetcher = store = None
 
+# File system probes and writes that steer the bridge logic, see util.FileSystem
+fs = util.FileSystem()
 
 
+
+@timeline.phase('isPendingClearcaseChanges')
 def isPendingClearcaseChanges():
     '''
     Returns a bool telling whether there are unsynchronized changes in clearcase.
+    The history is only read up to the first change, and the import pass that
+    usually follows continues from there.
+    '''
+    pending = cc.hasCheckinsSince(_watermark())
+    logger.info('Pending file changes in Clearcase: %s', 'yes' if pending else 'no')
+    return pending
+
+
+def _watermark():
     '''
+    The Watermark of the clearcase history imported. A bridge without one reads
+    checkin events from just after the latest commit on the cc branch.
+    '''
+    watermark = store.watermark()
+    if watermark:
+        return Watermark.parse(watermark)
     date = git.commitDate(CC_BRANCH) + timedelta(seconds=1)
-    since = datetime.strftime(date, '%d-%b-%Y.%H:%M:%S')
-    history = cc.checkinHistoryReversed(since)
-    logger.info('Pending file changes in Clearcase: %d', len(history))
-    return len(history) > 0
+    return Watermark(date.strftime('%Y%m%d.%H%M%S'))
 
 
 class GitCCBridge(object):
@@ -59,17 +80,47 @@ class GitCCBridge(object):
     '''
 
     def __init__(self, cfg):
-        global cc, git
+        global cc, git, fetcher, store
         self.git_dir = cfg.gitRoot()
         self.cc_dir = cfg.ccRoot()
         self.remote = cfg.remote()
+        self.fastImport = cfg.fastImport()
         git = GitFacade(self.git_dir)
-        cc = ClearcaseFacade(self.cc_dir, cfg.getInclude(), cfg.getBranches())
+        cc = ClearcaseFacade(self.cc_dir, cfg.getInclude(), cfg.getBranches(), cfg.ccSession(), cfg.checkinWorkers(), cfg.updateScope())
+        cache = BlobCache(cfg.blobCache(), cfg.blobCacheScope(), cfg.blobCacheSize()) if cfg.blobCache() else None
+        fetcher = VobFetcher(cc, join(git.git_dir, '.git', FETCH_AREA), cfg.fetchWorkers(), cache)
         self.commit_cache = join(self.git_dir, '.git', COMMIT_CACHE)
+        self.state_path = join(self.git_dir, '.git', STATE_DB)
+        store = BridgeState(self.state_path)
+        self.watermark = None
+        self.changedDirs = []
+        self.vobindex = VersionIndex(join(git.git_dir, '.git', VOB_INDEX))
+        self.rescanHours = cfg.fullRescanHours()
+        self.fullScan = False
         self.git_commits = []
         self.checkouts = []
 
+    def newCycle(self):
+        '''
+        Forget per-run state before the next cycle of a long-running bridge.
+        '''
+        git.clearCaches()
+        cc.closeProbe()
+        # The clearcase history read in the cycle tells which elements have changed
+        cc.markStale('new cycle', [])
+        self.fullScan = False
 
+    def close(self):
+        '''
+        Release long-lived helper processes held by the facades.
+        '''
+        fetcher.close()
+        git.close()
+        cc.close()
+        store.close()
+
+
+    @timeline.phase('newBridge')
     def newBridge(self, since=None):
         print str(datetime.now())[:19]
         if git.exists():
@@ -99,14 +150,13 @@ class GitCCBridge(object):
         git.init()
         # For each file in the view, copy it to the git repo directory and add it to git
         filedict = cc.fileVersionDictionary()
-        for file in filedict:
-            ccfile = '%s@@%s' % (file,filedict[file])
-            gitfile = os.path.join(git.git_dir, file)
-            if not os.path.exists(os.path.dirname(gitfile)):
-                # logger.info('creating dirs:', os.path.dirname(gitfile))
-                os.makedirs(os.path.dirname(gitfile))
-            cc.copyVobFile(ccfile, gitfile)
-            git.addFile(gitfile)
+        self.vobindex.replace(filedict)
+        self.vobindex.save()
+        jobs = [('%s@@%s' % (file, version), os.path.join(git.git_dir, file)) for file, version in filedict.iteritems()]
+        errors = fetcher.fetch(jobs)
+        if errors:
+            raise Exception('Could not fetch files from Clearcase:\n%s' % '\n'.join(['%s: %s' % ee for ee in errors]))
+        git.addFiles([gitfile for ccfile, gitfile in jobs])
         # Commit to git
         time = datetime.strptime(since, '%d-%b-%Y')
         env = os.environ
@@ -131,37 +181,43 @@ class GitCCBridge(object):
         os.remove(tmpfile.name)
 
 
+    @timeline.phase('onDoCheckinToClearcase')
     def onDoCheckinToClearcase(self):
         '''
         Pull any new commits from remote to master.
         For each pending commit to be checked in, merge it onto the cc branch and check in
-        it's file changes.
+        it's file changes. Returns the number of commits checked in.
+        The progress is kept in the bridge state, so that after a failed or interrupted
+        run the next one starts at the first commit not checked in.
         '''
         self._loadGitCommits()
-        head = git.branchHead(MASTER)
         self._updateMasterFromCentral() # ivar: This may not be safe since new commits have not been verified by CI
+        self._saveGitCommits()
         if len(self.git_commits) == 0:
             logger.info('No pending commits to check in to Clearcase')
-            return
+            return 0
+        logger.info('Checking in new commits to Clearcase...')
+        cc_head = git.branchHead(CC_BRANCH)
+        store.beginCheckin(cc_head)
         try:
-            logger.info('Checking in new commits to Clearcase...')
-            cc_head = git.branchHead(CC_BRANCH)
-            self._mergeCommitsOnBranch(CC_BRANCH, self.git_commits)
-            self._checkinCCBranch(cc_head)
-        except CheckoutReservedException:
-            # ivar: Need some smarter way to set bridge state after checkin failure
-            git.resetBranches({MASTER:head, CC_BRANCH:cc_head})
-            raise
+            self._mergeCommitsOnBranch(CC_BRANCH, self.git_commits, record=True)
+            checkins = self._checkinCCBranch(cc_head)
         except Exception:
-            git.resetBranches({MASTER:head, CC_BRANCH:cc_head})
+            self._rewindCheckin()
             raise
+        count = len(self.git_commits)
+        store.finishCheckin()
+        self.git_commits = []
+        cc.markStale('checked in %d commits' % count, checkins)
         if cc.needUpdate():
             logger.warning('Clearcase needs updating!')
             cc.update()
             logger.info('Clearcase updated')
         git.resetHard(MASTER)
+        return count
 
 
+    @timeline.phase('onNewClearcaseChanges')
     def onNewClearcaseChanges(self):
         '''
         + Make git commits from clearcase changes and add them to CC_BRANCH
@@ -175,8 +231,18 @@ class GitCCBridge(object):
         git.checkout(CC_BRANCH)
         cslist = self._getClearcaseChanges()
         cchead = git.branchHead(CC_BRANCH)
+        if cslist or self.changedDirs:
+            # One freshness check covers the whole batch of changesets. Directories
+            # changed without a changeset (e.g. the target of a move) are rescanned
+            # by _addDiscoveredChanges, so they are brought up to date as well
+            elements = [change.element for changeset in cslist or [] for change in changeset.changes]
+            cc.markStale('%d new changesets' % len(cslist or []), elements + self.changedDirs)
         if cslist:
             commits = self._commitToCCBranch(cslist)
+        if self.watermark:
+            store.setWatermark(str(self.watermark))
+        if cc.needUpdate():
+            cc.update()
         commits.extend(self._addDiscoveredChanges())
         if self.remote:
             self._updateMasterFromCentral()
@@ -193,24 +259,61 @@ class GitCCBridge(object):
                 self._pushMasterToCentral()
 
 
+    @timeline.phase('syncReport')
     def syncReport(self):
-        cc_snapshot = cc.fileVersionDictionary()
-        cc_files = cc_snapshot.keys()
+        '''
+        Return the files only in clearcase, with their versions, and the files only
+        on the cc branch. Both file lists are sorted, so they are compared in one
+        merging pass without building sets of them.
+        '''
+        cc_snapshot = self._vobVersions()
         git.checkout(CC_BRANCH)
-        git_files = git.filesList()
-
+        excludes = set(git_excludes)
+        cc_files = cc_snapshot.iteritems()
         # Filter out git files not synced in clearcase
-        git_files = list(set(git_files) - set(git_excludes))
-
-        added_in_cc = list(set(cc_files) - set(git_files))
-        added_in_git = list(set(git_files) - set(cc_files))
+        git_files = (ff for ff in git.indexFiles() if ff not in excludes)
 
         cc_dict = dict()
-        map(lambda xx: cc_dict.update({xx : cc_snapshot.get(xx)}), added_in_cc)
+        added_in_git = []
+        cc_entry = next(cc_files, None)
+        git_file = next(git_files, None)
+        while cc_entry is not None or git_file is not None:
+            if git_file is None or (cc_entry is not None and cc_entry[0] < git_file):
+                cc_dict[cc_entry[0]] = cc_entry[1]
+                cc_entry = next(cc_files, None)
+            elif cc_entry is None or git_file < cc_entry[0]:
+                added_in_git.append(git_file)
+                git_file = next(git_files, None)
+            else:
+                cc_entry = next(cc_files, None)
+                git_file = next(git_files, None)
         return (cc_dict, added_in_git)
 
 
 
+    def _vobVersions(self):
+        '''
+        Return the element versions in the view from the version index, rescanning
+        the whole view only when forced or when the index is missing or outdated, and
+        otherwise only the suspect directories.
+        '''
+        if self.fullScan or self.vobindex.needsFullScan(self.rescanHours):
+            logger.info('Scanning all element versions in the view')
+            self.vobindex.replace(cc.fileVersionDictionary())
+        else:
+            dirs = []
+            for dir in sorted(self.vobindex.suspects):
+                if not any([dir.startswith(dd + '/') for dd in dirs]):
+                    dirs.append(dir)
+            for dir in dirs:
+                logger.info('Rescanning element versions in %s', dir)
+                versions = cc.fileVersionDictionary([dir]) if fs.exists(join(self.cc_dir, dir)) else {}
+                self.vobindex.replaceSubtree(dir, versions)
+            self.vobindex.suspects = set()
+        self.vobindex.save()
+        return self.vobindex.versions
+
+
     def alignGitToClearcase(self, addition_dict, deletion_list):
         cs = ClearcaseChangeSet('Unknown', 'Anonymous file changes in Clearcase')
         time = datetime.now().strftime('%Y%m%d.%H%M%S')
@@ -222,6 +325,7 @@ class GitCCBridge(object):
         return self._commitToCCBranch([cs])
 
 
+    @timeline.phase('addDiscoveredChanges')
     def _addDiscoveredChanges(self):
         '''
         Check for discrepancies between git and clearcase. If any are found, update
@@ -236,6 +340,7 @@ class GitCCBridge(object):
         return self.alignGitToClearcase(addition_dict, deletion_list)
 
 
+    @timeline.phase('updateMasterFromCentral')
     def _updateMasterFromCentral(self):
         '''
         Get latest from remote (central) and save commits for later merging
@@ -253,14 +358,18 @@ class GitCCBridge(object):
                 self.git_commits.extend(commits)
 
 
-    def _mergeCommitsOnBranch(self, branch, commits):
+    @timeline.phase('mergeCommitsOnBranch')
+    def _mergeCommitsOnBranch(self, branch, commits, record=False):
         '''
         Checks out the branch and sequentially merges the commits onto it.
         In case of a conflict, the merge is aborted and an exception is raised.
+        With record, the resulting branch commit of each merge is kept in the bridge state.
         ivar: When the conflict is resolved, the resulting merge commit needs to
         be checked in to clearcase.
         '''
         git.checkout(branch)
+        git.loadCommits(commits)
+        head = git.branchHead(branch)
         for commitId in commits:
             msg = git.commitMessage(commitId)
             try:
@@ -270,6 +379,10 @@ class GitCCBridge(object):
                 logger.error('Exception caught: %s', str(e))
                 git.mergeAbort()
                 raise MergeConflictException(commitId, branch, str(e))
+            if record:
+                merged = git.branchHead(branch)
+                store.setMerged(commitId, merged if merged != head else None)
+                head = merged
 
 
     def _checkinCCBranch(self, old_head):
@@ -278,65 +391,120 @@ class GitCCBridge(object):
         Given the cc branch head representing the latest changes in clearcase, try to checkin all commits (sequentially) added from the central git repository.
         For each commit, first checkout all necessary files reserved, then write changes and make modifications, and last, checkin all files.
         This is the expected behavior. The raw functionality is to simply try to checkin to clearcase all commits between the old_head and HEAD on the cc branch.
+        Returns the elements checked in.
         '''
         git.checkout(CC_BRANCH)
-        history = git.commitHistoryPathBlob(old_head, CC_BRANCH)
         logger.info('Preparing to check in...')
-        for hentry in history.split('\x01'):
-            commitId, subject, body = hentry.split('\x02')
-            comment = subject if body == '\n' else '%s\n%s' % (subject, body)
-            comment = comment.strip('\n')
-            commitToCC = CommitToClearcase(commitId, comment, self.cc_dir)
-            commitToCC.checkoutClearcaseFiles()
-            commitToCC.updateClearcaseFiles()
-            commitToCC.checkinClearcaseFiles()
+        # The view reflects old_head until the batch adds to it
+        view = ViewTree(self.cc_dir, old_head)
+        checkins = []
+        for commitId, subject, body, status in git.commitChanges(old_head, CC_BRANCH):
+            comment = subject if body.strip('\n') == '' else '%s\n%s' % (subject, body)
+            comment = comment.strip('\n').replace('\x00', '') # cleartool cannot take NUL in -c
+            commitToCC = CommitToClearcase(commitId, comment, view, status, store.isInterruptedCheckin(commitId))
+            store.setCheckinState(commitId, CHECKINGIN)
+            with timeline.phase('commitToClearcase', commit=commitId, files=len(commitToCC.diffs)):
+                try:
+                    commitToCC.checkoutClearcaseFiles()
+                except Exception:
+                    # Its checkouts are undone before raising
+                    store.setCheckinState(commitId, MERGED)
+                    raise
+                # From here on the checkouts and new elements of a failure are left to _rewindCheckin
+                commitToCC.updateClearcaseFiles()
+                commitToCC.checkinClearcaseFiles()
+            store.setCheckinState(commitId, CHECKEDIN)
             logger.info('Checked in to Clearcase commit %s', commitId)
-            git.setTag(CI_TAG, commitId)
-        git.removeTag(CI_TAG)
+            for diff in commitToCC.diffs:
+                checkins.extend(diff.checkins)
+        return checkins
 
 
-    def _saveGitCommits(self):
-        if len(self.git_commits) == 0:
+    def _rewindCheckin(self):
+        '''
+        Reset the cc branch to the last commit checked in to clearcase by an unfinished
+        checkin batch, and make the commits merged after it pending again. Checkouts
+        left by a commit that was interrupted half way are undone, and the commit is
+        remembered, so that when it is checked in again the elements its interrupted
+        checkin already created, removed or moved are taken as they are (see AddDiff,
+        DelDiff and RenameDiff).
+        '''
+        if store.checkinBase() is None:
             return
-        logger.info('Saving commits cache: %s', self.git_commits)
-        concat_fn = lambda x,y: '%s\n%s' % (x,y)
-        commit_blob = reduce(concat_fn, self.git_commits)
-        ff = open(self.commit_cache, 'w')
-        ff.write(commit_blob)
-        ff.close()
+        interrupted = None
+        for commitId, ccCommit, checkinState in store.unfinishedCheckins():
+            if checkinState == CHECKINGIN:
+                interrupted = commitId
+                # The view has no checkouts between checkins, so all of them are the commit's.
+                # Contents go before their directories, so that new elements are undone first
+                checkouts = sorted(cc.checkouts(), reverse=True)
+                logger.warning('Undoing %d checkouts of the interrupted checkin of commit %s', len(checkouts), ccCommit)
+                failed, error = cc.undoCheckoutFiles(checkouts)
+                if failed:
+                    logger.error('Could not undo checkout of files [%s]\n   %s', ', '.join(failed), error)
+        last = store.lastCheckedIn()
+        logger.info('Resetting %s to %s, the last commit checked in to Clearcase', CC_BRANCH, last[:7])
+        git.resetBranches({CC_BRANCH:last})
+        store.rewindCheckin(interrupted)
+
+
+    def _saveGitCommits(self):
+        if self.git_commits:
+            logger.info('Saving %d pending commits', len(self.git_commits))
+            logger.debug('Pending commits: %s', self.git_commits)
+        store.setPendingCommits(self.git_commits)
 
 
     def _loadGitCommits(self):
+        '''
+        Take over the commit cache of an older bridge, rewind a checkin batch left
+        unfinished and load the pending commits.
+        '''
         if exists(self.commit_cache):
             ff = open(self.commit_cache, 'r')
-            blob = ff.read()
+            store.setPendingCommits(ff.read().split('\n'))
             ff.close()
-            self.git_commits = blob.split('\n')
             os.remove(self.commit_cache)
-            logger.info('Loading commits cache: %s', self.git_commits)
+        self._rewindCheckin()
+        self.git_commits = store.pendingCommits()
+        if self.git_commits:
+            logger.info('Loading %d pending commits', len(self.git_commits))
+            logger.debug('Pending commits: %s', self.git_commits)
 
 
+    @timeline.phase('getClearcaseChanges')
     def _getClearcaseChanges(self):
         '''
         Retreives latest changes from clearcase and commits them to the cc branch (CC_BRANCH)
+        Each changeset gets the watermark of the history up to and including it, and
+        self.watermark that of the whole history read.
         '''
         logger.debug('')
-        date = git.commitDate(CC_BRANCH) + timedelta(seconds=1)
-        since = datetime.strftime(date, '%d-%b-%Y.%H:%M:%S')
-        history = cc.checkinHistoryReversed(since)
+        self.watermark = None
+        self.changedDirs = []
+        watermark = _watermark()
+        history = cc.checkinHistoryReversed(watermark)
         if len(history) == 0:
+            history.close()
             return None
         cslist = []
 
-        _, t_time, t_user, _, _, t_comment = history[0].split('\x01')
-        changeset = ClearcaseChangeSet(t_user, t_comment)
-        for line in history:
-            type, time, user, file, version, comment = line.split('\x01')
+        changeset = None
+        for event in history:
+            self.vobindex.update(event)
+            type, time, user, file, version, comment = event.type, event.time, event.user, event.file, event.version, event.comment
+            if type != 'checkinversion':
+                # Suspect in the version index as well, see _vobVersions
+                self.changedDirs.append(file)
+            if changeset is None:
+                t_time, t_user, t_comment = time, user, comment
+                changeset = ClearcaseChangeSet(t_user, t_comment)
 
             if type == 'checkinversion':
                 if user != t_user or comment != t_comment:
                     if not changeset.isempty():
                         logger.info('Loading changeset "%s" - [ %s ]', changeset.comment.split('\n')[0].strip(), changeset)
+                        changeset.watermark = watermark.copy()
                         cslist.append(changeset)
                     changeset = ClearcaseChangeSet(user, comment)
                 changeset.add(ClearcaseModify(time, self.git_dir, file, version))
@@ -346,27 +514,83 @@ class GitCCBridge(object):
                 if util.timeDiff(t_time, time) > 4:
                     if not changeset.isempty():
                         logger.info('Loading changeset "%s" - [ %s ]', changeset.comment.split('\n')[0].strip(), changeset)
+                        changeset.watermark = watermark.copy()
                         cslist.append(changeset)
                     changeset = ClearcaseChangeSet(user, comment)
                 changeset.add(createClearcaseDelete(time, self.git_dir, file, version, comment))
                 t_time, t_user, t_comment = time, user, comment
 
+            watermark.advance(event)
+
         if not changeset.isempty():
             logger.info('Loading changeset "%s" - [ %s ]', changeset.comment.split('\n')[0].strip(), changeset)
+            changeset.watermark = watermark.copy()
             cslist.append(changeset)
+        self.watermark = watermark
+        history.close()
+        self.vobindex.save()
         return cslist
 
 
     def _commitToCCBranch(self, cslist):
+        if self.fastImport:
+            return self._fastImportToCCBranch(cslist)
         commits = []
         git.checkout(CC_BRANCH)
-        for changeset in cslist:
-            commitId = changeset.commitToGit()
+        for ii, changeset in enumerate(cslist):
+            # Fetch files for the next changeset while this one is committed
+            fetcher.prefetch(changeset.versions())
+            if ii + 1 < len(cslist):
+                fetcher.prefetch(cslist[ii + 1].versions())
+            with timeline.phase('commitToGit', comment=changeset.comment.split('\n')[0].strip(), files=len(changeset.changes)):
+                commitId = changeset.commitToGit()
             if commitId:
                 commits.append(commitId)
+            if changeset.watermark:
+                store.setWatermark(str(changeset.watermark))
         return commits
 
 
+    def _fastImportToCCBranch(self, cslist):
+        '''
+        Same as _commitToCCBranch, but streams the changesets through git fast-import
+        and brings the work tree up to date once at the end. If the import fails, the
+        changesets imported until then are kept, and the first error is raised.
+        '''
+        commits = []
+        git.checkout(CC_BRANCH)
+        importer = git.fastImport(CC_BRANCH)
+        watermark = None
+        error = None
+        try:
+            for ii, changeset in enumerate(cslist):
+                fetcher.prefetch(changeset.versions())
+                if ii + 1 < len(cslist):
+                    fetcher.prefetch(cslist[ii + 1].versions())
+                with timeline.phase('fastImport', comment=changeset.comment.split('\n')[0].strip(), files=len(changeset.changes)):
+                    commitId = changeset.fastImport(importer)
+                if commitId:
+                    commits.append(commitId)
+                watermark = changeset.watermark or watermark
+        except:
+            error = sys.exc_info()
+        try:
+            importer.close()
+            git.resetHard(CC_BRANCH)
+        except Exception:
+            if error is None:
+                raise
+            logger.error('Could not close the fast-import after a failed import:\n%s', traceback.format_exc())
+        else:
+            # The branch only moves when the import is closed
+            if watermark:
+                store.setWatermark(str(watermark))
+        if error:
+            raise error[0], error[1], error[2]
+        return commits
+
+
+    @timeline.phase('pushMasterToCentral')
     def _pushMasterToCentral(self):
         '''
         Push CC stuff from master to remote central
@@ -392,32 +616,40 @@ class CommitToClearcase(object):
     This is a helper class to perform updates in Clearcase corresponding to
     commits in Git.
     '''
-    def __init__(self, commitId, comment, cc_dir):
+    def __init__(self, commitId, comment, view, status, resume=False):
         self.commitId = commitId
         self.comment = comment
-        self.diffs = self._getCommitFileChanges(self.commitId, cc_dir)
+        self.diffs = self._getCommitFileChanges(self.commitId, view, status, resume)
 
+    @timeline.phase('checkoutClearcaseFiles')
     def checkoutClearcaseFiles(self):
         self._checkoutReservedOrRaise(self._filesToCheckout())
 
+    @timeline.phase('updateClearcaseFiles')
     def updateClearcaseFiles(self):
+        '''
+        Write the changes to the checked out elements. On failure the checkouts and
+        the elements created are left as they are, for the checkin to be rewound.
+        '''
         try:
             for diff in self.diffs:
                 diff.updateCCArea()
         except Exception as e:
             traceback.print_exc()
-            for file in self._filesToCheckout():
-                cc.undoCheckout(file)
-            raise UpdateCCAreaException(diff.commitId, str(e))
+            raise UpdateCCAreaException(self.commitId, str(e))
 
+    @timeline.phase('checkinClearcaseFiles')
     def checkinClearcaseFiles(self):
         files = []
         for diff in self.diffs:
             files.extend(diff.checkins)
         files = list(set(files)) # remove duplicates
+        failed, error = cc.checkinFiles(files, self.comment)
         for file in files:
-            cc.checkin(file, self.comment)
-            logger.debug('Checked in to Clearcase file %s', file)
+            if file not in failed:
+                logger.debug('Checked in to Clearcase file %s', file)
+        if failed:
+            raise Exception(error)
 
     def _filesToCheckout(self):
         files = []
@@ -426,40 +658,38 @@ class CommitToClearcase(object):
         return list(set(files)) # remove duplicates
 
     def _checkoutReservedOrRaise(self, files):
-        passed = []
-        notpassed = []
-        for ff in files:
-            try:
-                cc.checkout(ff)
-                passed.append(ff)
-            except Exception as e:
-                notpassed.append(ff)
-                error = str(e)
+        notpassed, error = cc.checkoutFiles(files)
+        passed = [ff for ff in files if ff not in notpassed]
         if len(notpassed) > 0:
-            for pp in passed:
-                cc.undoCheckout(pp)
+            self._undoCheckouts(passed)
             raise CheckoutReservedException(notpassed, error)
         return passed # Only for testability
 
-    def _getCommitFileChanges(self, commitId, cc_dir):
+    def _undoCheckouts(self, files):
+        failed, error = cc.undoCheckoutFiles(files)
+        if failed:
+            logger.error('Could not undo checkout of files [%s]\n   %s', ', '.join(failed), error)
+
+    def _getCommitFileChanges(self, commitId, view, status, resume=False):
         '''
-        Given a commit, return a list with Diff objects, containing type symbol and files affected.
+        Given a commit and its name-status (see GitFacade.commitChanges), return a list
+        with Diff objects, containing type symbol and files affected. With resume, the
+        Diffs take over what an interrupted checkin of the commit already did.
         '''
         diffs = []
-        status = git.diffsByCommit(commitId)
         status = status.strip(' \x00')
         split = status.split('\x00')
         while len(split) > 1:
             symbol = split.pop(0)[0] # first char
             file = split.pop(0)
             if symbol == 'R':
-                diffs.append(RenameDiff(commitId, cc_dir, file, split.pop(0)))
+                diffs.append(RenameDiff(commitId, view, file, split.pop(0), resume))
             elif symbol == 'A':
-                diffs.append(AddDiff(commitId, cc_dir, file))
+                diffs.append(AddDiff(commitId, view, file, resume))
             elif symbol == 'D':
-                diffs.append(DelDiff(cc_dir, file))
+                diffs.append(DelDiff(view, file, resume))
             elif symbol == 'M':
-                diffs.append(ModDiff(commitId, cc_dir, file))
+                diffs.append(ModDiff(commitId, view, file))
             else:
                 raise Exception("Unknown status on file: (%s,%s)" % (symbol, file))
         return diffs
@@ -477,6 +707,7 @@ class ClearcaseChangeSet(object):
         self.comment = comment
         self.changes = []
         self.time = None
+        self.watermark = None
 
     def __str__(self):
         return ','.join(map(lambda a: a.file, self.changes))
@@ -488,9 +719,20 @@ class ClearcaseChangeSet(object):
         self.changes.append(change)
         self.time = datetime.strptime(change.time, '%Y%m%d.%H%M%S')
 
+    def versions(self):
+        '''
+        The element versions (file@@version) this changeset needs fetched from clearcase.
+        '''
+        return [change.ccfile for change in self.changes if isinstance(change, ClearcaseModify)]
+
     def commitToGit(self):
+        errors = fetcher.fetch([(ccfile, None) for ccfile in self.versions()])
+        if errors:
+            raise Exception('Could not fetch files from Clearcase:\n%s' % '\n'.join(['%s: %s' % ee for ee in errors]))
+        batch = IndexBatch()
         for change in self.changes:
-            change.stage()
+            change.stage(batch)
+        batch.apply()
         if cc.needUpdate():
             cc.update()
         env = os.environ
@@ -510,147 +752,235 @@ class ClearcaseChangeSet(object):
             return None
 
 
+    def fastImport(self, importer):
+        '''
+        Same as commitToGit, but builds the commit through the given FastImport.
+        '''
+        errors = fetcher.fetch([(ccfile, None) for ccfile in self.versions()])
+        if errors:
+            raise Exception('Could not fetch files from Clearcase:\n%s' % '\n'.join(['%s: %s' % ee for ee in errors]))
+        changes = OrderedDict()
+        for change in self.changes:
+            if isinstance(change, ClearcaseModify):
+                changes[change.file] = fetcher.read(change.ccfile)
+            else:
+                changes[change.file] = (None, False)
+        if cc.needUpdate():
+            cc.update()
+        if self.comment.strip() == '':
+            self.comment = '<empty comment>'
+        name = users.getUserName(self.userId).encode()
+        email = str(users.getUserEmail(self.userId))
+        commitId = importer.commit(name, email, self.time, self.comment, [(file, data, executable) for file, (data, executable) in changes.items()])
+        if commitId:
+            logger.info('Committed to branch %s change [%s] -> %s', CC_BRANCH, self.comment.split('\n')[0].strip(), commitId[:7])
+        else:
+            logger.info('Nothing new to commit [%s]', self.comment.split('\n')[0].strip())
+        return commitId
+
+
+class IndexBatch(object):
+    '''
+    Collects the additions and removals of a changeset, in order, so that they can be
+    applied to the git index in one update each. A later change to a file cancels an
+    earlier, opposite one. Additions with a known blob sha are staged from the blob.
+    '''
+    def __init__(self):
+        self.adds = OrderedDict()
+        self.removals = OrderedDict()
+
+    def add(self, file, sha=None):
+        self.removals.pop(file, None)
+        self.adds[file] = sha
+
+    def remove(self, file):
+        if file in self.adds:
+            del self.adds[file]
+            # Written to the work tree by this changeset, but never staged
+            fs.remove(join(git.git_dir, file))
+        self.removals[file] = True
+
+    def apply(self):
+        git.removeFiles(self.removals.keys())
+        files = [file for file, sha in self.adds.items() if sha is None]
+        files.extend(git.addBlobs([(file, sha) for file, sha in self.adds.items() if sha is not None]))
+        git.addFiles(files)
+
+
 class ClearcaseModify(object):
     def __init__(self, time, git_dir, file, version):
         self.time = time
         self.git_dir = git_dir
         self.file = file
         self.version = version
+        self.ccfile = '%s@@%s' % (self.file, self.version)
+        # The element the change is loaded in the view with
+        self.element = self.file
 
-    def stage(self):
+    def stage(self, batch):
         toFile = join(self.git_dir, self.file)
-        util.prepareForCopy(toFile)
-        ccfile = '%s@@%s' % (self.file, self.version)
-        cc.copyVobFile(ccfile, toFile)
-        git.addFile(self.file)
+        fs.prepareForCopy(toFile)
+        batch.add(self.file, fetcher.place(self.ccfile, toFile))
 
 
 def createClearcaseDelete(time, git_dir, dir, version, comment):
     # dir = join(git_dir, dir)
     file = re.search('\"(.+)\"', comment).group(1)
     file = join(dir, file)
-    return ClearcaseDelete(time, git_dir, file)
+    return ClearcaseDelete(time, git_dir, file, dir)
 
 
 class ClearcaseDelete(object):
-    def __init__(self, time, git_dir, file):
+    def __init__(self, time, git_dir, file, dir=None):
         self.time = time
         self.git_dir = git_dir
         self.file = file
+        # The file leaves the view when the directory it was uncataloged from is updated
+        self.element = dir if dir else dirname(file) or '.'
 
     # ivar: if needed, give git_dir as an argument to stage()
-    def stage(self):
-        if not exists(join(self.git_dir, self.file)):
+    def stage(self, batch):
+        if not fs.exists(join(self.git_dir, self.file)):
             logger.info('File marked for deletion does not exist in the git repository: %s' % join(self.git_dir, self.file))
             return
-        git.removeFile(self.file)
+        batch.remove(self.file)
 
 
 
 
+class ViewTree(object):
+    '''
+    Tells the Diff classes which directories exist in the view, so that a checkin
+    batch looks up each directory at most once. Seeded with the directories of the
+    cc branch commit the view reflects; others are probed in the view once and
+    remembered. Directories the bridge adds are recorded as it goes.
+    '''
+    def __init__(self, root, ref=None):
+        self.root = root
+        self.dirs = {'': True}
+        if ref:
+            for dir in git.directories(ref):
+                self.dirs[dir] = True
+
+    def exists(self, dir):
+        if dir not in self.dirs:
+            self.dirs[dir] = fs.exists(join(self.root, dir))
+        return self.dirs[dir]
+
+    def addDirectory(self, dir):
+        cc.addDirectory(dir)
+        self.dirs[dir] = True
+
+    def missingDirectories(self, dir):
+        '''
+        Return the directories from dir up that do not exist in the view, deepest first,
+        and the deepest existing one ('.' for the view root).
+        '''
+        path = []
+        while not self.exists(dir):
+            path.append(dir)
+            dir = dirname(dir)
+        return path, '.' if dir == '' else dir
+
+
 class ModDiff():
-    def __init__(self, commitId, viewroot, file):
+    def __init__(self, commitId, view, file):
         self.commitId = commitId
-        self.viewroot = viewroot
+        self.view = view
         self.file = file
         self.checkouts = self.checkins = [self.file]
 
     def updateCCArea(self):
         blob = git.blob(self.commitId, self.file)
-        f = open(join(self.viewroot, self.file), 'wb')
-        f.write(blob)
-        f.close()
+        fs.writeFile(join(self.view.root, self.file), blob)
 
 
 class AddDiff():
-    def __init__(self, commitId, viewroot, file):
+    def __init__(self, commitId, view, file, resume=False):
         self.commitId = commitId
-        self.viewroot = viewroot
+        self.view = view
         self.file = file
-        self._extractCCFiles()
-
-    def _extractCCFiles(self):
-        dst = dirname(self.file)
-        path = []
-        while not exists(join(self.viewroot, dst)):
-            path.append(dst)
-            dst = dirname(dst)
-        dst = '.' if dst == '' else dst
+        self._extractCCFiles(resume)
+
+    def _extractCCFiles(self, resume):
+        path, dst = self.view.missingDirectories(dirname(self.file))
+        # An element created by an interrupted checkin of the commit is only modified
+        self.element = resume and not path and fs.exists(join(self.view.root, self.file)) and self.file in cc.fileVersionDictionary([self.file])
+        if self.element:
+            logger.info('Element %s already exists, checking it in as modified', self.file)
+            self.checkouts = self.checkins = [self.file]
+            return
         self.checkouts = [dst]
         self.checkins = [self.file, dst]
         self.checkins.extend(path)
 
     def updateCCArea(self):
-        dir = dirname(self.file)
-        path = []
-        while not exists(join(self.viewroot, dir)):
-            path.append(dir)
-            dir = dirname(dir)
+        path, dir = self.view.missingDirectories(dirname(self.file))
         while len(path) > 0:
-            cc.addDirectory(path.pop())
+            self.view.addDirectory(path.pop())
         blob = git.blob(self.commitId, self.file)
-        f = open(join(self.viewroot, self.file), 'wb')
-        f.write(blob)
-        f.close()
-        cc.addFile(self.file)
+        fs.writeFile(join(self.view.root, self.file), blob)
+        if not self.element:
+            cc.addFile(self.file)
 
 
 class DelDiff():
-    def __init__(self, viewroot, file):
-        self.viewroot = viewroot
+    def __init__(self, view, file, resume=False):
+        self.view = view
         self.file = file
-        self._extractCCFiles()
+        self._extractCCFiles(resume)
 
-    def _extractCCFiles(self):
+    def _extractCCFiles(self, resume):
         '''
         Collect which elements to checkout and checkin on, respectively.
         '''
-        dst = dirname(self.file)
-        while not exists(join(self.viewroot, dst)):
-            dst = dirname(dst)
-        dst = '.' if dst == '' else dst
+        # Removed already by an interrupted checkin of the commit
+        self.removed = resume and not fs.exists(join(self.view.root, self.file))
+        if self.removed:
+            logger.info('Element %s is already removed', self.file)
+            self.checkouts = self.checkins = []
+            return
+        path, dst = self.view.missingDirectories(dirname(self.file))
         self.checkouts = [dst]
         self.checkins = [dst]
 
     def updateCCArea(self):
         ## We are not purging empty directory elements after delete
-        cc.removeFile(self.file)
+        if not self.removed:
+            cc.removeFile(self.file)
 
 
 class RenameDiff():
-    def __init__(self, commitId, viewroot, file, dst):
+    def __init__(self, commitId, view, file, dst, resume=False):
         self.commitId = commitId
-        self.viewroot = viewroot
+        self.view = view
         self.file = file
         self.dst = dst
-        self._extractCCFiles()
-
-    def _extractCCFiles(self):
+        self._extractCCFiles(resume)
+
+    def _extractCCFiles(self, resume):
+        # Moved already by an interrupted checkin of the commit, leaving its contents to write
+        self.moved = resume and not fs.exists(join(self.view.root, self.file)) and fs.exists(join(self.view.root, self.dst))
+        if self.moved:
+            logger.info('Element %s is already moved to %s, checking it in as modified', self.file, self.dst)
+            self.checkouts = self.checkins = [self.dst]
+            return
         src_dir = dirname(self.file)
         src_dir = '.' if src_dir == '' else src_dir
-        dst_dir = dirname(self.dst)
-        path = []
-        while not exists(join(self.viewroot, dst_dir)):
-            path.append(dst_dir)
-            dst_dir = dirname(dst_dir)
-        dst_dir = '.' if dst_dir == '' else dst_dir
+        path, dst_dir = self.view.missingDirectories(dirname(self.dst))
         self.checkouts = [self.file, src_dir, dst_dir]
         self.checkins = [self.dst, src_dir, dst_dir]
         self.checkins.extend(path)
 
     def updateCCArea(self):
-        # Copy the contents of the 'new' file in the git area to the 'old' file in the cc area
         blob = git.blob(self.commitId, self.dst)
-        f = open(join(self.viewroot, self.file), 'wb')
-        f.write(blob)
-        f.close()
+        if self.moved:
+            fs.writeFile(join(self.view.root, self.dst), blob)
+            return
+        # Copy the contents of the 'new' file in the git area to the 'old' file in the cc area
+        fs.writeFile(join(self.view.root, self.file), blob)
 
-        dst_dir = dirname(self.dst)
-        path = []
-        while not exists(join(self.viewroot, dst_dir)):
-            path.append(dst_dir)
-            dst_dir = dirname(dst_dir)
+        path, dst_dir = self.view.missingDirectories(dirname(self.dst))
         while len(path) > 0:
-            cc.addDirectory(path.pop())
+            self.view.addDirectory(path.pop())
         cc.moveFile(self.file, self.dst)
-
@@ -1,57 +1,197 @@
 from sys import argv
 import traceback
 import bridge
+import metrics
+import timeline
+import replay
 import logging
 import logging.handlers
+import logqueue
 import util
 import optparse
+import os
+import errno
+import time
 
 desc = 'A Git-Clearcase bridge aimed to synchronize between a designated area in a Cleacase snapshot view and a corresponding bare git repository.'
-usage = '%prog [-c PATH] tocc|togit|update'
+usage = '%prog [-c PATH] tocc|togit|update|daemon'
 
 
 def initLogging(cfg):
-    logger = logging.getLogger()
-    logger.setLevel(logging.NOTSET)
-    h = logging.StreamHandler()
-    h.setFormatter(logging.Formatter('> %(message)s'))
-    h.setLevel(logging.INFO)
-    logger.addHandler(h)
+    '''
+    Route all logging through a queue to a background writer, see logqueue.py.
+    Returns the writer, to be flushed (sending the error digest) after each run.
+    '''
+    console = logging.StreamHandler()
+    console.setFormatter(logging.Formatter('> %(message)s'))
+    console.setLevel(logging.INFO)
 
-    logger = logging.getLogger('log.bgcc.file')
     h = logging.handlers.RotatingFileHandler(cfg.logFile(), maxBytes=130000, backupCount=1)
     h.setFormatter(logging.Formatter('%(asctime)s [%(module)s.%(funcName)s] %(message)s'))
     h.setLevel(logging.DEBUG)
-    logger.addHandler(h)
+    h.addFilter(logging.Filter('log.bgcc.file'))
+
+    ## Log errors to email recipient, one digest mail per run
+    m = logqueue.DigestMailHandler(cfg.smtpServer(), cfg.emailSender(), cfg.emailRecipients(), 'Bridge error alert!')
+    m.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    m.setLevel(logging.ERROR)
+    m.addFilter(logging.Filter('log.bgcc.file'))
 
-    ## Log errors to email recipient
-    h = logging.handlers.SMTPHandler(cfg.smtpServer(), cfg.emailSender(), cfg.emailRecipients(), 'Bridge error alert!')
-    h.setFormatter(logging.Formatter('%(message)s'))
-    h.setLevel(logging.ERROR)
-    logger.addHandler(h)
+    queue = logqueue.Queue.Queue()
+    listener = logqueue.QueueListener(queue, console, h, m)
+    logger = logging.getLogger()
+    logger.setLevel(logging.NOTSET)
+    logger.addHandler(logqueue.QueueHandler(queue))
+    listener.start()
+    return listener
 
 
 
 
 def printUsage():
-    print 'You need to specify an action: [tocc|togit|update]'
+    print 'You need to specify an action: [tocc|togit|update|daemon]'
+
+
+def isRunning(pid):
+    '''
+    Whether a process with the given pid is running.
+    '''
+    if os.name == 'nt':
+        # os.kill would terminate the process on Windows
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(0x1000, False, pid) # PROCESS_QUERY_LIMITED_INFORMATION
+        if not handle:
+            return kernel32.GetLastError() == 5 # ERROR_ACCESS_DENIED
+        code = ctypes.c_ulong()
+        ok = kernel32.GetExitCodeProcess(handle, ctypes.byref(code))
+        kernel32.CloseHandle(handle)
+        return not ok or code.value == 259 # STILL_ACTIVE
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def acquireLock(cfg):
+    '''
+    Make sure bridge runs never overlap, e.g. a cron job and a running daemon.
+    A lock left by a run that is no longer running is taken over.
+    '''
+    lock = cfg.logFile() + '.lock'
+    try:
+        fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except OSError:
+        ff = open(lock, 'r')
+        pid = ff.read().strip()
+        ff.close()
+        # A lock without a pid may be being written by a run just starting
+        if not pid.isdigit() or isRunning(int(pid)):
+            raise Exception('Another bridge run is in progress (remove %s if it is not)' % lock)
+        logging.getLogger('log.bgcc.file').warning('Removing the lock of bridge run %s, which is no longer running', pid)
+        os.remove(lock)
+        fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    os.write(fd, str(os.getpid()))
+    os.close(fd)
+    return lock
+
+
+def logError(logger, e):
+    if isinstance(e, bridge.MergeConflictException):
+        logger.error('Error: Could not merge commit %s onto branch %s\n   %s' % e.args)
+    elif isinstance(e, bridge.CheckoutReservedException):
+        logger.error('Error: Could not checkout files [%s]\n   %s' % e.args)
+    elif isinstance(e, bridge.UpdateCCAreaException):
+        logger.error('Error: Could not update files for commit %s\n   %s' % e.args)
+    else:
+        logger.error('Something unexpected has happened: %s', str(e))
+    traceback.print_exc()
+
+
+def writeMetrics(cfg):
+    if cfg.metricsFile():
+        try:
+            metrics.write(cfg.metricsFile())
+        except Exception as e:
+            logging.getLogger('log.bgcc.file').warning('Could not write metrics: %s', str(e))
+
+
+def writeProfile(path):
+    try:
+        timeline.write(path)
+    except Exception as e:
+        logging.getLogger('log.bgcc.file').warning('Could not write profile: %s', str(e))
+
+
+def runDaemon(bb, cfg, listener, profile=None):
+    '''
+    Keep the bridge alive and synchronize in both directions in one loop. The
+    polling interval is reset to the minimum after any activity, and doubled up
+    to the maximum while idle or after errors. With profile, the timeline of each
+    cycle replaces that of the one before.
+    '''
+    logger = logging.getLogger('log.bgcc.file')
+    minInterval, maxInterval = cfg.pollInterval()
+    interval = minInterval
+    while True:
+        bb.newCycle()
+        try:
+            active = False
+            if bridge.isPendingClearcaseChanges():
+                bb.onNewClearcaseChanges()
+                active = True
+            if bb.onDoCheckinToClearcase():
+                active = True
+            interval = minInterval if active else min(interval * 2, maxInterval)
+        except Exception as e:
+            logError(logger, e)
+            interval = min(interval * 2, maxInterval)
+        writeMetrics(cfg)
+        if profile:
+            writeProfile(profile)
+            timeline.clear()
+        listener.flush()
+        logger.debug('Next poll in %d seconds', interval)
+        time.sleep(interval)
 
 def main():
     parser = optparse.OptionParser(description=desc, usage=usage)
     parser.add_option('-c', '--config', metavar='PATH', action='store', type='string', dest='config', help='Let\'s you rovide a custom path to a configuration file')
+    parser.add_option('--record', metavar='PATH', action='store', type='string', dest='record', help='Record all facade and file system calls of the run to PATH')
+    parser.add_option('--replay', metavar='PATH', action='store', type='string', dest='replay', help='Replay a recorded run from PATH without running git or cleartool')
+    parser.add_option('--profile', metavar='PATH', action='store', type='string', dest='profile', help='Write a timeline of the bridge phases and commands to PATH, in the Chrome trace-event format')
+    parser.add_option('--profile-python', action='store_true', dest='profilePython', default=False, help='With --profile, also run the outermost phases under cProfile')
+    parser.add_option('-f', '--full-scan', action='store_true', dest='fullScan', default=False, help='Rescan all element versions in the view instead of relying on the version index')
     options, args = parser.parse_args()
     if len(args) < 1:
         printUsage()
         exit(1)
 
     cfg = util.GitConfigParser(options.config)
-    initLogging(cfg)
+    listener = initLogging(cfg)
     logger = logging.getLogger('log.bgcc.file')
     logger.info('Git repository at: %s', cfg.gitRoot())
     logger.info('Clearcase view at: %s', cfg.ccRoot())
-    bb = bridge.GitCCBridge(cfg)
     try:
-        if args[0] == 'tocc':
+        lock = acquireLock(cfg)
+    except Exception as e:
+        logger.error(str(e))
+        listener.stop()
+        exit(1)
+    bb = recording = None
+    try:
+        if options.profile:
+            timeline.start(options.profilePython)
+        bb = bridge.GitCCBridge(cfg)
+        bb.fullScan = options.fullScan
+        if options.record:
+            recording = replay.record(bb, options.record)
+        elif options.replay:
+            replay.replay(bb, options.replay)
+        if args[0] == 'daemon':
+            runDaemon(bb, cfg, listener, options.profile)
+        elif args[0] == 'tocc':
             bb.onDoCheckinToClearcase()
         elif args[0] == 'togit':
             if bridge.isPendingClearcaseChanges():
@@ -59,6 +199,7 @@ def main():
         elif args[0] == 'init':
             bb.newBridge(args[1])
         elif args[0] == 'update':
+            bridge.cc.markStale('update action')
             if not bridge.cc.needUpdate():
                 logger.info('Clearcase view is up to date')
             else:
@@ -67,18 +208,22 @@ def main():
         else:
             printUsage()
             exit(1)
-    except bridge.MergeConflictException as mce:
-        logger.error('Error: Could not merge commit %s onto branch %s\n   %s' % mce.args)
-        traceback.print_exc()
-    except bridge.CheckoutReservedException as cre:
-        logger.error('Error: Could not checkout files [%s]\n   %s' % cre.args)
-        traceback.print_exc()
-    except bridge.UpdateCCAreaException as uae:
-        logger.error('Error: Could not update files for commit %s\n   %s' % uae.args)
-        traceback.print_exc()
+    except KeyboardInterrupt:
+        logger.info('Interrupted')
     except Exception as e:
-        logger.error('Something unexpected has happened: %s', str(e))
-        traceback.print_exc()
+        logError(logger, e)
+    finally:
+        try:
+            if bb:
+                bb.close()
+            if recording:
+                recording.close()
+            writeMetrics(cfg)
+            if options.profile:
+                writeProfile(options.profile)
+        finally:
+            os.remove(lock)
+            listener.stop()
 
 
 if __name__ == '__main__':
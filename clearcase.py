@@ -1,87 +1,588 @@
 import os, stat, os.path
 import tempfile
 import re
+import shutil
+import threading
+import Queue
+import itertools
 import util
 import logging
+import time
+import metrics
+from subprocess import STDOUT
+from datetime import datetime, timedelta
 
-# This is temporary stuff just for recording, set level to DEBUG to enable
 logger = logging.getLogger('log.bgcc.file')
-recorder = logging.getLogger('log.bgcc.clearcase')
-# h = logging.FileHandler('ccrecorder.log', 'w')
-# h.setFormatter(logging.Formatter('%(message)s'))
-# h.setLevel(logging.INFO)
-# recorder.addHandler(h)
 
 
-def formatRecord(res, *args):
-    xx = '(%s, \'%s\'),' % (str(args), str(res))
-    return xx
+# Budget for the pathnames of a single multi-path command, well below the Windows
+# command line limit
+CMDLINE_LIMIT = 7000
+
+
+def _normpath(path):
+    path = re.sub('[\\\\/]+', '/', path)
+    while path.startswith('./'):
+        path = path[2:]
+    return path
+
+
+def _depth(path):
+    path = _normpath(path).strip('/')
+    return 0 if path in ('', '.') else path.count('/') + 1
+
+
+def elementName(path):
+    '''
+    Normalize an element path the way fileVersionDictionary does.
+    '''
+    return re.sub('^[\./]*', '', path.replace('\\', '/'))
+
+
+VERSION_LINE = re.compile('version\s+(\S+)')
+
+
+class VersionStore(object):
+    '''
+    A compact dictionary of element versions (file -> branch/version) for large
+    VOBs. Files are kept per directory, with the directory names and the versions
+    interned, so that each full path is only built when iterated. Iteration is in
+    sorted (byte) order of the full paths, like git ls-files.
+    '''
+    def __init__(self):
+        self.dirs = {}
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, file):
+        dir, base = self._split(file)
+        return base in self.dirs.get(dir, ())
+
+    def __getitem__(self, file):
+        dir, base = self._split(file)
+        return self.dirs[dir][base]
+
+    def get(self, file, default=None):
+        dir, base = self._split(file)
+        return self.dirs.get(dir, {}).get(base, default)
+
+    def __setitem__(self, file, version):
+        dir, base = self._split(file)
+        files = self.dirs.get(dir)
+        if files is None:
+            files = self.dirs[intern(dir)] = {}
+        if base not in files:
+            self.count += 1
+        files[base] = intern(version)
+
+    def __delitem__(self, file):
+        dir, base = self._split(file)
+        del self.dirs[dir][base]
+        self.count -= 1
+        if not self.dirs[dir]:
+            del self.dirs[dir]
+
+    def __iter__(self):
+        for file, version in self.iteritems():
+            yield file
+
+    def keys(self):
+        return list(self)
+
+    def iteritems(self):
+        # Walk the directory tree, ordering a directory by its name with a trailing
+        # slash among the files next to it, which gives byte order of the full paths
+        subdirs = {}
+        for dir in self.dirs:
+            while dir:
+                parent, base = self._split(dir)
+                siblings = subdirs.setdefault(parent, set())
+                if base in siblings:
+                    break
+                siblings.add(base)
+                dir = parent
+        stack = [('', None)]
+        while stack:
+            dir, version = stack.pop()
+            if version is not None:
+                yield dir, version
+                continue
+            prefix = dir + '/' if dir else ''
+            entries = [(base, prefix + base, self.dirs[dir][base]) for base in self.dirs.get(dir, ())]
+            entries.extend([(base + '/', prefix + base, None) for base in subdirs.get(dir, ())])
+            entries.sort(reverse=True)
+            stack.extend([(path, version) for base, path, version in entries])
+
+    def items(self):
+        return list(self.iteritems())
+
+    def update(self, versions):
+        for file, version in versions.iteritems():
+            self[file] = version
+
+    def removeSubtree(self, dir):
+        prefix = dir + '/'
+        for dd in [dd for dd in self.dirs if dd == dir or dd.startswith(prefix)]:
+            self.count -= len(self.dirs.pop(dd))
+
+    def _split(self, file):
+        dir, sep, base = file.rpartition('/')
+        return dir, base
+
+
+class VersionIndex(object):
+    '''
+    On-disk index of element versions in the view (as from fileVersionDictionary),
+    kept up to date from the checkin events the bridge processes. Directories with
+    new versions are marked as suspect, since element renames and removals only
+    show up as directory checkins, and are rescanned on their own. A full rescan
+    is only needed when the index is missing or too old.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.versions = None
+        self.suspects = set()
+        self.lastFullScan = None
+        self._load()
+
+    def needsFullScan(self, hours):
+        if self.versions is None or self.lastFullScan is None or '' in self.suspects:
+            return True
+        return datetime.now() - self.lastFullScan > timedelta(hours=hours)
+
+    def replace(self, versions):
+        self.versions = versions
+        self.suspects = set()
+        self.lastFullScan = datetime.now()
+
+    def replaceSubtree(self, dir, versions):
+        self.versions.removeSubtree(dir)
+        self.versions.update(versions)
+        self.suspects.discard(dir)
+
+    def update(self, event):
+        if self.versions is None:
+            return
+        name = elementName(event.file)
+        if event.type == 'checkinversion':
+            self.versions[name] = event.version
+        else:
+            self.suspects.add(name)
+
+    def save(self):
+        if self.versions is None:
+            return
+        tmp = self.path + '.tmp'
+        ff = open(tmp, 'wb')
+        ff.write('#full %s\n' % self.lastFullScan.strftime('%Y%m%d.%H%M%S'))
+        for dir in sorted(self.suspects):
+            ff.write('#suspect %s\n' % dir)
+        for file, version in self.versions.iteritems():
+            ff.write('%s\x01%s\n' % (file, version))
+        ff.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(tmp, self.path)
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        versions = VersionStore()
+        ff = open(self.path, 'rb')
+        for line in ff:
+            line = line.rstrip('\n')
+            if line.startswith('#full '):
+                self.lastFullScan = datetime.strptime(line[6:], '%Y%m%d.%H%M%S')
+            elif line.startswith('#suspect '):
+                self.suspects.add(line[9:])
+            elif line:
+                file, version = line.split('\x01', 1)
+                versions[file] = version
+        ff.close()
+        self.versions = versions
+
+
+class CheckinEvent(object):
+    '''
+    A checkin event from the clearcase history.
+    '''
+    __slots__ = ('type', 'time', 'user', 'file', 'version', 'oid', 'comment')
+
+    def __init__(self, type, time, user, file, version, oid, comment):
+        self.type = type
+        self.time = time
+        self.user = user
+        self.file = file
+        self.version = version
+        self.oid = oid
+        self.comment = comment
+
+    def __str__(self):
+        return '\x01'.join([self.type, self.time, self.user, self.file, self.version, self.oid, self.comment])
+
+    def __repr__(self):
+        return repr(str(self))
+
+    @staticmethod
+    def parse(line):
+        return CheckinEvent(*line.split('\x01', 6))
+
+
+class Watermark(object):
+    '''
+    How far the clearcase history has been imported: the time of the latest event
+    imported, and the OIDs of the events imported at that time. lsh -since only
+    resolves seconds, so the history is read from that time on and the events
+    already imported are skipped by OID.
+    '''
+    def __init__(self, time, oids=()):
+        self.time = time
+        self.oids = set(oids)
+
+    def advance(self, event):
+        if event.time > self.time:
+            self.time = event.time
+            self.oids = set([event.oid])
+        elif event.time == self.time:
+            self.oids.add(event.oid)
+
+    def copy(self):
+        return Watermark(self.time, self.oids)
+
+    def since(self):
+        return datetime.strptime(self.time, '%Y%m%d.%H%M%S').strftime('%d-%b-%Y.%H:%M:%S')
+
+    def __str__(self):
+        return '%s\x01%s' % (self.time, ','.join(sorted(self.oids)))
+
+    def __repr__(self):
+        return repr(str(self))
+
+    @staticmethod
+    def parse(text):
+        time, oids = text.split('\x01', 1)
+        return Watermark(time, [oid for oid in oids.split(',') if oid])
+
+
+class CheckinHistory(object):
+    '''
+    Checkin events in the order they were made (oldest first). cleartool lists the
+    history newest first, so the events are spilled to a temporary file as they
+    are read, and the file is read backwards block by block when iterated.
+    '''
+    blocksize = 64*1024
+
+    def __init__(self, lines):
+        self.spill = tempfile.TemporaryFile()
+        self.count = 0
+        for line in lines:
+            self.spill.write(line + '\n')
+            self.count += 1
+        self.spill.flush()
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        ff = self.spill
+        ff.seek(0, os.SEEK_END)
+        pos = ff.tell()
+        tail = ''
+        while pos > 0:
+            step = min(self.blocksize, pos)
+            pos -= step
+            ff.seek(pos)
+            lines = (ff.read(step) + tail).split('\n')
+            tail = lines.pop(0)
+            for line in reversed(lines):
+                if line:
+                    yield CheckinEvent.parse(line)
+        if tail:
+            yield CheckinEvent.parse(tail)
+
+    def close(self):
+        self.spill.close()
+
+
+class ClearcaseSession(object):
+    '''
+    Keeps one interactive 'cleartool -status' process alive and feeds it commands
+    over stdin. After each command cleartool prints 'Command N returned status S',
+    which frames the command output (stderr is merged into stdout). A dead process
+    is restarted on the next command.
+    '''
+    status = re.compile('^Command \d+ returned status (\d+)\s*$')
+
+    def __init__(self, cc_dir):
+        self.cc_dir = cc_dir
+        self.pipe = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def canSend(cmd):
+        '''
+        Multi-line arguments, and arguments containing both quote characters, cannot
+        be expressed on the interactive command line.
+        '''
+        return not any(['\n' in a or ('"' in a and "'" in a) for a in cmd])
+
+    def execute(self, cmd, errors=True):
+        with self.lock:
+            return self._execute(cmd, errors)
+
+    def _execute(self, cmd, errors):
+        if self.pipe is None or self.pipe.poll() is not None:
+            self.pipe = util.spawn('cleartool', ['-status'], self.cc_dir, stderr=STDOUT)
+        line = ' '.join(map(self._quote, cmd))
+        logger.log(logging.DEBUG-5, 'cleartool> %s', line)
+        start = time.time()
+        try:
+            self.pipe.stdin.write(line + '\n')
+            self.pipe.stdin.flush()
+        except IOError:
+            self.pipe = None
+            raise Exception('cleartool session terminated before: %s' % line)
+        out = []
+        while True:
+            ll = self.pipe.stdout.readline()
+            if ll == '':
+                self.pipe = None
+                raise Exception('cleartool session terminated during: %s\n%s' % (line, ''.join(out)))
+            match = self.status.match(ll)
+            if match:
+                break
+            out.append(ll)
+        out = ''.join(out)
+        metrics.record('cleartool', metrics.subcommand(cmd), time.time() - start, int(match.group(1)), len(out))
+        if errors and int(match.group(1)) > 0:
+            raise Exception(out)
+        return out
+
+    def close(self):
+        if self.pipe is None:
+            return
+        try:
+            self.pipe.stdin.write('quit\n')
+            self.pipe.stdin.close()
+            self.pipe.wait()
+        except (IOError, OSError):
+            pass
+        self.pipe = None
+
+    def _quote(self, arg):
+        if arg != '' and not re.search('[\s"\']', arg):
+            return arg
+        return "'%s'" % arg if '"' in arg else '"%s"' % arg
 
 
 class ClearcaseFacade(object):
-    def __init__(self, cc_dir, includes, branches):
+    def __init__(self, cc_dir, includes, branches, session=False, checkinWorkers=1, updateScope='paths'):
         self.cc_dir = cc_dir
         self.includes = includes
         self.branches = branches
+        self.checkinWorkers = max(1, checkinWorkers)
+        self.updateScope = updateScope
+        # checkin event on one of the configured branches, from an lsh -fmt line
+        self.checkinMatcher = re.compile('^checkin[^\x01]*\x01[^\x01]+\x01[^\x01]+\x01[^\x01]+\x01([^\x01]*/)?(%s)/\d+\x01' % '|'.join(map(re.escape, branches)))
+        self.session = ClearcaseSession(cc_dir) if session else None
+        # View freshness: when the view was last confirmed current, and what has
+        # happened since that may have made it stale
+        self.confirmed = None
+        self.eventsSince = []
+        # The elements marked stale, or None if any element may be. With the 'paths'
+        # update scope the bridge marks every element it sees change, from the
+        # clearcase history and its own checkins, so no element is stale to begin with.
+        self.stalePaths = set() if updateScope == 'paths' else None
+        # (since, first line, rest of the lines) of a history read by hasCheckinsSince
+        self.probe = None
+
+    def close(self):
+        self.closeProbe()
+        if self.session:
+            self.session.close()
+
+    def markStale(self, event, paths=None):
+        '''
+        Record something that may have made the view stale, so that the next
+        needUpdate asks clearcase again. Give the element paths that may have
+        changed, if known, to limit the check and the update to them.
+        '''
+        self.eventsSince.append(event)
+        if paths is None:
+            self.stalePaths = None
+        elif self.stalePaths is not None:
+            self.stalePaths.update(paths)
 
     def needUpdate(self):
         '''
         Checks whether an update would result in any changes to the clearcase
-        working files.
+        working files (below the update scope, see update). If the view has been
+        confirmed current and nothing has been marked since, clearcase is not asked.
         '''
+        if self.confirmed and not self.eventsSince:
+            logger.debug('View confirmed current at %s', self.confirmed)
+            return False
+        logger.debug('Checking view freshness after: %s', self.eventsSince)
+        scope = self._updateScope()
+        hits = []
         (fd, tmpfile) = tempfile.mkstemp()
         os.close(fd)
-        self._cc_exec(['update', '-print', '-ove', '-log', tmpfile])
-        ff = open(tmpfile, 'r')
-        buf = ff.read()
-        ff.close()
-        os.remove(tmpfile)
-        hits = re.findall('^Updated:', buf, re.M)
-        recorder.debug('%s', formatRecord(len(hits) > 0))
+        try:
+            try:
+                for chunk in self._chunks(scope if scope is not None else self.includes):
+                    hits.extend(self._printUpdates(tmpfile, chunk))
+            except Exception as e:
+                logger.warning('Scoped update check failed, checking the whole view: %s', str(e))
+                hits = self._printUpdates(tmpfile, [])
+        finally:
+            os.remove(tmpfile)
+        if len(hits) == 0:
+            self._confirmCurrent()
         return len(hits) > 0
 
-    def fileVersionDictionary(self):
+    def fileVersionDictionary(self, paths=None):
         '''
-        Return a dictionary containing all versioned files in the clearcase view, with their corresponding branch/version.
+        Return a VersionStore containing all versioned files in the clearcase view, with their corresponding branch/version.
+        Give paths to only list the files below them instead of below the configured include folders.
+        The ls output is parsed as it is read.
         '''
         ls = ['ls', '-long', '-recurse', '-vob']
-        ls.extend(self.includes)
-        vob = self._cc_exec(ls)
-        vob = re.findall('^(version.*)', vob, re.M)
-        fileversions = map(lambda ss: re.match('version\s+([^\s]+)', ss).group(1).replace('\\','/'), vob)
-        vobdict = {}
-        for fv in fileversions:
-            obj = re.match('[\./]*(.+)@@(.+)', fv, re.M)
+        ls.extend(paths if paths else self.includes)
+        vobdict = VersionStore()
+        for line in util.stream('cleartool', ls, self.cc_dir):
+            obj = VERSION_LINE.match(line)
             if not obj:
+                continue
+            fv = obj.group(1).replace('\\', '/').lstrip('./')
+            file, sep, version = fv.rpartition('@@')
+            if not sep or not file or not version:
                 logger.error('No cc version format: %s', fv)
             else:
-                vobdict[obj.group(1)] = obj.group(2)
-        recorder.debug('%s', formatRecord(vobdict))
+                vobdict[file] = version
         return vobdict
 
-    def checkinHistoryReversed(self, since):
-        lsh = ['lsh', '-fmt', '%o%m\001%Nd\001%u\001%En\001%Vn\001%Nc\n', '-recurse', '-since', since]
+    def checkinHistoryReversed(self, watermark):
+        '''
+        Return a CheckinHistory with the checkin events on the configured branches
+        after the given Watermark, oldest first. The lsh output is parsed as it is read.
+        Only the first line of multi-line comments is kept.
+        '''
+        since = str(watermark)
+        if self.probe and self.probe[0] == since:
+            first, lines = self.probe[1:]
+            self.probe = None
+            lines = itertools.chain([first], lines)
+        else:
+            lines = self._checkinLines(watermark)
+        history = CheckinHistory(lines)
+        logger.debug('Checkin events since %s: %d', watermark.since(), len(history))
+        return history
+
+    def hasCheckinsSince(self, watermark):
+        '''
+        Tell whether there are checkin events on the configured branches after the
+        given Watermark, reading the history only up to the first one. The rest is
+        left unread for a following checkinHistoryReversed with the same watermark,
+        and cleartool is killed if none follows.
+        '''
+        lines = self._checkinLines(watermark)
+        first = next(lines, None)
+        if first is None:
+            return False
+        self.probe = (str(watermark), first, lines)
+        return True
+
+    def closeProbe(self):
+        if self.probe:
+            self.probe[2].close()
+            self.probe = None
+
+    def _checkinLines(self, watermark):
+        self.closeProbe()
+        lsh = ['lsh', '-fmt', '%o%m\001%Nd\001%u\001%En\001%Vn\001%On\001%Nc\n', '-recurse', '-since', watermark.since()]
         lsh.extend(self.includes) ## To filter our folders specified in configuration
-        blob = self._cc_exec(lsh).replace('\\', '/') # clean up windows separator ugliness
-        ptrn = '^(checkin.+?\x01.+?\x01.+?\x01.+?\x01.+[%s]/\d+\x01.*)' % ','.join(self.branches)
-        filtered = re.findall(ptrn, blob, re.M)
-        filtered.reverse()
-        logger.debug(filtered)
-        recorder.debug('%s', formatRecord(filtered, since, self.includes))
-        return filtered
-
-    def copyVobFile(self, ccfile, dest):
+        return self._filterCheckins(util.stream('cleartool', lsh, self.cc_dir), watermark.oids)
+
+    def _filterCheckins(self, lines, seen=()):
+        for line in lines:
+            line = line.rstrip('\r\n').replace('\\', '/') # clean up windows separator ugliness
+            if self.checkinMatcher.match(line) and line.split('\x01', 6)[5] not in seen:
+                yield line
+
+    def copyVobFile(self, ccfile, dest, session=True):
         if os.path.exists(dest):
             os.remove(dest)
-        self._cc_exec(['get','-to', dest, ccfile])
+        self._cc_exec(['get','-to', dest, ccfile], session=session)
         os.chmod(dest, os.stat(dest).st_mode | stat.S_IWRITE)
-        recorder.debug('%s', formatRecord(None, ccfile, dest))
 
     def undoCheckout(self, file):
         self._cc_exec(['unco', '-rm', file])
 
+    def undoCheckoutFiles(self, files):
+        '''
+        Multi-path version of undoCheckout. Returns a tuple with the files that
+        could not be processed and the error output.
+        '''
+        return self._cc_exec_paths(['unco', '-rm'], files)
+
+    def checkinFiles(self, files, comment):
+        '''
+        Check in files with one comment. With more than one checkin worker, file
+        elements are checked in from that many cleartool processes at once, and then
+        directory elements, deepest first, so that a directory is checked in after
+        its contents. Returns the failed files and the errors, like _cc_exec_paths.
+        '''
+        cmd = ['ci', '-identical', '-c', comment]
+        if self.checkinWorkers == 1:
+            return self._cc_exec_paths(cmd, files)
+        dirs = set([ff for ff in files if os.path.isdir(os.path.join(self.cc_dir, ff))])
+        levels = [[ff for ff in files if ff not in dirs]]
+        for depth, group in itertools.groupby(sorted(dirs, key=_depth, reverse=True), _depth):
+            levels.append(list(group))
+        failed = []
+        errors = []
+        for level in levels:
+            ff, error = self._cc_exec_paths_concurrently(cmd, level)
+            failed.extend(ff)
+            if error:
+                errors.append(error)
+        return (failed, '\n'.join(errors))
+
+    def checkouts(self):
+        '''
+        The elements checked out in the view below the configured include folders.
+        '''
+        output = self._cc_exec(['lsco', '-cview', '-short', '-recurse'] + self.includes)
+        return [_normpath(line.strip()) for line in output.splitlines() if line.strip()]
+
+    def checkoutFiles(self, files):
+        '''
+        Multi-path version of checkout. A chunk whose failure names no file is
+        reported failed as a whole, and its checkouts are undone, so that no element
+        reported failed is left checked out.
+        '''
+        return self._cc_exec_paths(['co', '-reserved', '-nc'], files, undo=['unco', '-rm'])
+
     def update(self):
-        self._cc_exec(['update', '-overwrite'])
+        '''
+        Update the view below the update scope: the elements marked stale when they
+        are known (see markStale), else the include folders. The whole view is
+        updated with the 'view' update scope, or if a scoped update fails.
+        '''
+        scope = self._updateScope()
+        if scope is None:
+            self._cc_exec(['update', '-overwrite'])
+        else:
+            logger.debug('Updating %d paths of the view', len(scope))
+            try:
+                for chunk in self._chunks(scope):
+                    self._cc_exec(['update', '-overwrite'] + chunk)
+            except Exception as e:
+                logger.warning('Scoped update failed, updating the whole view: %s', str(e))
+                self._cc_exec(['update', '-overwrite'])
+        self._confirmCurrent()
 
     def checkin(self, file, comment):
         self._cc_exec(['ci', '-identical', '-c', comment, file])
@@ -109,13 +610,248 @@ class ClearcaseFacade(object):
     def setcs(self, csfile):
         print 'setting config spec to: %s' % csfile
         self._cc_exec(['setcs', csfile])
+        self.markStale('setcs %s' % csfile)
         print 'done'
 
 
-    def _cc_exec(self, cmd, **args):
-        return util.popen('cleartool', cmd, self.cc_dir, **args)
+    def _confirmCurrent(self):
+        self.confirmed = datetime.now()
+        self.eventsSince = []
+        self.stalePaths = set()
 
+    def _printUpdates(self, tmpfile, paths):
+        '''
+        The updates an update of paths (the whole view if none) would make.
+        '''
+        self._cc_exec(['update', '-print', '-ove', '-log', tmpfile] + paths)
+        ff = open(tmpfile, 'r')
+        hits = re.findall('^Updated:', ff.read(), re.M)
+        ff.close()
+        return hits
+
+    def _updateScope(self):
+        '''
+        The pathnames to check and update, None for the whole view. Stale elements
+        not loaded in the view are covered by their nearest loaded directory.
+        '''
+        if self.updateScope == 'view':
+            return None
+        if self.updateScope != 'paths' or self.stalePaths is None:
+            return self.includes
+        dirs = set()
+        for path in self.stalePaths:
+            path = _normpath(path).strip('/')
+            while path not in ('', '.') and not os.path.exists(os.path.join(self.cc_dir, path)):
+                path = os.path.dirname(path)
+            dirs.add(path if path not in ('', '.') else '.')
+        if '.' in dirs:
+            return self.includes
+        scope = []
+        for path in sorted(dirs):
+            if not scope or not path.startswith(scope[-1] + '/'):
+                scope.append(path)
+        return scope
+
+    def _cc_exec_paths(self, cmd, files, session=True, undo=None):
+        '''
+        Run cmd on many pathnames, chunked to stay under the command line limit.
+        cleartool processes every pathname and reports failures per element, so the
+        failed files are picked from the quoted names in its error lines. If no name
+        can be recognized, the whole chunk is considered failed, and the undo
+        command, if given, is run on it to revert the elements that did succeed.
+        '''
+        failed = []
+        errors = []
+        for chunk in self._chunks(files):
+            try:
+                self._cc_exec(cmd + chunk, session=session)
+            except Exception as e:
+                errors.append(str(e))
+                reported = set()
+                for line in re.findall('^cleartool: Error: (.*)$', str(e), re.M):
+                    reported.update(map(_normpath, re.findall('"([^"]+)"', line)))
+                hit = [ff for ff in chunk if _normpath(ff) in reported]
+                failed.extend(hit if hit else chunk)
+                if not hit and undo:
+                    # Elements that were not processed make the undo fail, which is expected
+                    self._cc_exec(undo + chunk, errors=False, session=session)
+        return (failed, '\n'.join(errors))
+
+    def _cc_exec_paths_concurrently(self, cmd, files):
+        '''
+        Same as _cc_exec_paths, with the files split between up to checkinWorkers
+        threads, each running its own cleartool processes (the session is not shared).
+        '''
+        size = max(1, (len(files) + self.checkinWorkers - 1) // self.checkinWorkers)
+        groups = [files[ii:ii + size] for ii in range(0, len(files), size)]
+        if len(groups) <= 1:
+            return self._cc_exec_paths(cmd, files)
+        results = [None] * len(groups)
+        def work(ii):
+            try:
+                results[ii] = self._cc_exec_paths(cmd, groups[ii], session=False)
+            except Exception as e:
+                results[ii] = (groups[ii], str(e))
+        threads = [threading.Thread(target=work, args=(ii,)) for ii in range(len(groups))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        failed = []
+        errors = []
+        for ff, error in results:
+            failed.extend(ff)
+            if error:
+                errors.append(error)
+        return (failed, '\n'.join(errors))
+
+    def _chunks(self, files):
+        chunk = []
+        size = 0
+        for ff in files:
+            if chunk and size + len(ff) + 3 > CMDLINE_LIMIT:
+                yield chunk
+                chunk = []
+                size = 0
+            chunk.append(ff)
+            size += len(ff) + 3
+        if chunk:
+            yield chunk
+
+    def _cc_exec(self, cmd, errors=True, session=True, **args):
+        if session and self.session and ClearcaseSession.canSend(cmd):
+            return self.session.execute(cmd, errors=errors)
+        return util.popen('cleartool', cmd, self.cc_dir, errors=errors, **args)
+
+
+
+class FetchJob(object):
+    def __init__(self, ccfile, dest):
+        self.ccfile = ccfile
+        self.dest = dest
+        self.error = None
+        self.sha = None
+        self.done = threading.Event()
+
+
+class VobFetcher(object):
+    '''
+    Fetches element versions ('file@@version') with 'cleartool get' from a bounded
+    pool of worker threads. Versions are either fetched straight to a given
+    destination, or to a private area from where they are later placed in the git
+    work tree, which makes it safe to prefetch the next changeset while the current
+    one is being committed. Staging order is left to the caller.
+    With a blob cache (see blobcache.py), versions fetched before are copied from
+    the cache instead, and their git blob sha is known.
+    '''
+    def __init__(self, cc, area, workers=4, cache=None):
+        self.cc = cc
+        self.cache = cache
+        self.area = area
+        self.workers = max(1, workers)
+        self.queue = Queue.Queue()
+        self.jobs = {}
+        self.threads = []
+        self.count = 0
+
+    def prefetch(self, ccfiles):
+        '''
+        Start fetching the given versions to the fetch area without waiting.
+        '''
+        for ccfile in ccfiles:
+            self._submit(ccfile, None)
+
+    def fetch(self, jobs):
+        '''
+        Fetch the given (ccfile, dest) pairs, dest being None for the fetch area, and
+        wait for them to finish. Return a list of (ccfile, error) for failed fetches.
+        '''
+        jobs = [self._submit(ccfile, dest) for ccfile, dest in jobs]
+        errors = []
+        for job in jobs:
+            job.done.wait()
+            if job.error:
+                self.jobs.pop(job.ccfile, None)
+                errors.append((job.ccfile, job.error))
+        return errors
+
+    def place(self, ccfile, dest):
+        '''
+        Move a version fetched to the fetch area into place, fetching it directly if
+        it is not available. Return the git blob sha of the version if it is known.
+        '''
+        job = self.jobs.pop(ccfile, None)
+        if job:
+            job.done.wait()
+        if job and not job.error and os.path.exists(job.dest):
+            shutil.move(job.dest, dest)
+            return job.sha
+        return self._get(ccfile, dest)
+
+    def read(self, ccfile):
+        '''
+        Return the contents of a version fetched to the fetch area, and whether it
+        is executable, and remove it there.
+        '''
+        tmp = os.path.join(self.area, 'read')
+        self.place(ccfile, tmp)
+        ff = open(tmp, 'rb')
+        data = ff.read()
+        ff.close()
+        executable = util.isExecutable(tmp)
+        os.remove(tmp)
+        return data, executable
 
+    def close(self):
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        self.jobs = {}
+        if os.path.exists(self.area):
+            shutil.rmtree(self.area, ignore_errors=True)
+        if self.cache:
+            self.cache.close()
 
+    def _submit(self, ccfile, dest):
+        if dest is None and ccfile in self.jobs:
+            return self.jobs[ccfile]
+        if not self.threads:
+            for ii in range(self.workers):
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+        if dest is None:
+            if not os.path.exists(self.area):
+                os.makedirs(self.area)
+            self.count += 1
+            job = FetchJob(ccfile, os.path.join(self.area, str(self.count)))
+            self.jobs[ccfile] = job
+        else:
+            job = FetchJob(ccfile, dest)
+        self.queue.put(job)
+        return job
 
+    def _work(self):
+        # A single worker may keep using the interactive session, many may not
+        session = self.workers == 1
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            try:
+                util.prepareForCopy(job.dest)
+                job.sha = self._get(job.ccfile, job.dest, session)
+            except Exception as e:
+                job.error = str(e)
+            job.done.set()
 
+    def _get(self, ccfile, dest, session=True):
+        sha = self.cache.get(ccfile, dest) if self.cache else None
+        if sha is None:
+            self.cc.copyVobFile(ccfile, dest, session=session)
+            if self.cache:
+                sha = self.cache.put(ccfile, dest)
+        return sha
@@ -1,22 +1,153 @@
 import re
+import time
+import hashlib
 from datetime import datetime
 import util
+import metrics
 import logging
 import os.path
 import os
 
 logger = logging.getLogger('log.bgcc.file')
 
-# This is temporary stuff just for recording, set level to DEBUG to enable
-recorder = logging.getLogger('log.bgcc.git')
-# h = logging.FileHandler('gitrecorder.log', 'w')
-# h.setFormatter(logging.Formatter('%(message)s'))
-# h.setLevel(logging.INFO)
-# recorder.addHandler(h)
 
-def formatRecord(res, *args):
-    xx = '(%s, \'%s\'),' % (str(args), str(res))
-    return xx
+# NUL-delimited commit metadata, one record per commit (-z terminates records with NUL as well)
+METADATA_FORMAT = '%H%x00%ci%x00%an%x00%ae%x00%B'
+METADATA_FIELDS = 5
+# Keep 'git log --no-walk' command lines well below the Windows limit
+METADATA_CHUNK = 400
+
+
+class BlobReader(object):
+    '''
+    Wraps a long-lived 'git cat-file --batch' process, resolving '<commit>:<path>'
+    specs to blob contents over a single pipe. The process is started lazily and
+    restarted if it has died.
+    '''
+    def __init__(self, git_dir):
+        self.git_dir = git_dir
+        self.pipe = None
+
+    def read(self, spec):
+        if self.pipe is None or self.pipe.poll() is not None:
+            self.pipe = util.spawn('git', ['cat-file', '--batch'], self.git_dir)
+        start = time.time()
+        self.pipe.stdin.write(spec + '\n')
+        self.pipe.stdin.flush()
+        header = self.pipe.stdout.readline()
+        if header == '':
+            self.close()
+            raise Exception('git cat-file terminated while reading %s' % spec)
+        fields = header.split()
+        if len(fields) != 3:
+            raise Exception('Could not resolve blob %s: %s' % (spec, header.strip()))
+        sha, type, size = fields
+        blob = self.pipe.stdout.read(int(size))
+        self.pipe.stdout.read(1) # trailing newline
+        metrics.record('git', 'cat-file', time.time() - start, 0, len(blob))
+        if type != 'blob':
+            raise Exception('Not a blob: %s (%s)' % (spec, type))
+        return blob
+
+    def close(self):
+        if self.pipe is None:
+            return
+        try:
+            self.pipe.stdin.close()
+            self.pipe.wait()
+        except (IOError, OSError):
+            pass
+        self.pipe = None
+
+
+def _rawDate(date):
+    '''
+    Format a local, naive datetime as '<epoch> <+hhmm>' for git fast-import.
+    '''
+    epoch = int(time.mktime(date.timetuple()))
+    offset = datetime.fromtimestamp(epoch) - datetime.utcfromtimestamp(epoch)
+    minutes = (offset.days*24*60*60 + offset.seconds) // 60
+    sign = '+' if minutes >= 0 else '-'
+    return '%d %s%02d%02d' % (epoch, sign, abs(minutes) // 60, abs(minutes) % 60)
+
+
+class FastImport(object):
+    '''
+    Builds commits on a branch through a single 'git fast-import' process, without
+    touching the index or the work tree. The sha of each new commit is read back
+    with 'get-mark', and paths are checked with 'ls' so that changes which leave
+    the tree as it is do not produce empty commits.
+    '''
+    def __init__(self, git_dir, branch, parent, fileMode=True):
+        self.branch = branch
+        self.tip = parent
+        self.fileMode = fileMode
+        self.mark = 0
+        self.pipe = util.spawn('git', ['fast-import', '--quiet', '--done'], git_dir)
+
+    def commit(self, name, email, date, message, changes):
+        '''
+        Commit the list of (path, data, executable) changes, data being None for
+        removals. Return the new commit id, or None if nothing would change.
+        '''
+        changes = [(path, data, self._mode(executable)) for path, data, executable in changes]
+        changes = [(path, data, mode) for path, data, mode in changes if self._changes(path, data, mode)]
+        if not changes:
+            return None
+        self.mark += 1
+        who = '%s <%s> %s' % (name, email, _rawDate(date))
+        self._write('commit refs/heads/%s\nmark :%d\nauthor %s\ncommitter %s\n' % (self.branch, self.mark, who, who))
+        self._write('data %d\n%s\n' % (len(message), message))
+        self._write('from %s\n' % self.tip)
+        for path, data, mode in changes:
+            if data is None:
+                self._write('D %s\n' % self._quote(path))
+            else:
+                self._write('M %s inline %s\ndata %d\n' % (mode, self._quote(path), len(data)))
+                self._write(data)
+                self._write('\n')
+        self._write('\nget-mark :%d\n' % self.mark)
+        self.tip = ':%d' % self.mark
+        return self._readline().strip()
+
+    def close(self):
+        if self.pipe is None:
+            return
+        self._write('done\n')
+        self.pipe.stdin.close()
+        self.pipe.wait()
+        returncode = self.pipe.returncode
+        self.pipe = None
+        if returncode != 0:
+            raise Exception('git fast-import failed with exit code %d' % returncode)
+
+    def _mode(self, executable):
+        return '100755' if executable and self.fileMode else '100644'
+
+    def _changes(self, path, data, mode):
+        self._write('ls %s %s\n' % (self.tip, self._quote(path)))
+        res = self._readline()
+        if res.startswith('missing '):
+            return data is not None
+        if data is None:
+            return True
+        sha = hashlib.sha1('blob %d\x00%s' % (len(data), data)).hexdigest()
+        return res.split('\t')[0].split(' ')[0::2] != [mode, sha]
+
+    def _quote(self, path):
+        if not path.startswith('"') and '\n' not in path:
+            return path
+        return '"%s"' % path.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    def _write(self, buf):
+        self.pipe.stdin.write(buf)
+
+    def _readline(self):
+        self.pipe.stdin.flush()
+        res = self.pipe.stdout.readline()
+        if res == '':
+            raise Exception('git fast-import terminated unexpectedly')
+        return res
 
 
 class GitFacade(object):
@@ -24,6 +155,19 @@ class GitFacade(object):
         self.git_dir = os.path.abspath(git_dir)
         if not os.path.exists(self.git_dir):
             os.makedirs(self.git_dir)
+        self.blobReader = BlobReader(self.git_dir)
+        # Per-run caches: commit metadata keyed by sha, and resolved refs. The latter is
+        # invalidated whenever the facade itself moves a ref.
+        self.metadata = {}
+        self.heads = {}
+        self.trustFileMode = None
+
+    def close(self):
+        self.blobReader.close()
+
+    def clearCaches(self):
+        self.metadata.clear()
+        self.heads.clear()
 
     def init(self):
         self._git_exec(['init'])
@@ -31,14 +175,25 @@ class GitFacade(object):
     def exists(self):
         return os.path.exists(os.path.join(self.git_dir, '.git'))
 
-    def diffsByCommit(self, commitId):
-        diffs = self._git_exec(['diff','--name-status', '-M', '-z', '%s^..%s' % (commitId, commitId)])
-        recorder.debug('%s', formatRecord(diffs, commitId))
-        return diffs
-
     def resetHard(self, ref):
         self._git_exec(['reset', '--hard', ref])
-        recorder.debug('%s', formatRecord(None, ref))
+        self.heads.clear()
+
+    def fastImport(self, branch):
+        '''
+        Return a FastImport building commits on top of the given branch. The branch
+        ref is moved by fast-import itself, so the index and work tree of a checked
+        out branch must be reset once the import is closed.
+        '''
+        return FastImport(self.git_dir, branch, self.branchHead(branch), self.fileMode())
+
+    def fileMode(self):
+        '''
+        Whether git stages the executable bit of work tree files (core.fileMode).
+        '''
+        if self.trustFileMode is None:
+            self.trustFileMode = self._git_exec(['config', '--bool', 'core.fileMode'], errors=False).strip() != 'false'
+        return self.trustFileMode
 
     def resetBranches(self, branches):
         for branch in branches.keys():
@@ -46,99 +201,206 @@ class GitFacade(object):
             self.resetHard(branches[branch])
 
     def checkout(self, ref):
+        self.heads.pop('HEAD', None)
         try:
             self._git_exec(['checkout', ref])
         except:
             self._git_exec(['checkout', '-b', ref])
-        recorder.debug('%s', formatRecord(None, ref))
+            self.heads.clear()
 
     def addFile(self, file):
         # ivar: why errors=False?
         self._git_exec(['add', '-f', file], errors=False)
-        recorder.debug('%s', formatRecord(None, file))
 
     def removeFile(self, file):
         self._git_exec(['rm', file])
-        recorder.debug('%s', formatRecord(None, file))
+
+    def addFiles(self, files):
+        '''
+        Stage many files with a single index update.
+        '''
+        if not files:
+            return
+        try:
+            self._git_exec(['add', '-f', '--pathspec-from-file=-', '--pathspec-file-nul'], input='\x00'.join(files))
+        except Exception as e:
+            # Fall back to the forgiving per-file add if the batch is rejected as a whole
+            logger.warning('Batch add failed, adding files one by one: %s', str(e))
+            for file in files:
+                self.addFile(file)
+
+    def addBlobs(self, blobs):
+        '''
+        Stage (file, sha) pairs from blobs already known, without hashing the files.
+        Return the files whose blobs are not in the object database, which are left
+        for addFiles. A blob is only found if git stored the same contents before, so
+        files that git converts when adding them (autocrlf) are still added that way.
+        The mode is taken from the work tree file, as git add does.
+        '''
+        if not blobs:
+            return []
+        found = self._git_exec(['cat-file', '--batch-check'], input=''.join(['%s\n' % sha for file, sha in blobs])).splitlines()
+        entries = []
+        missing = []
+        for (file, sha), line in zip(blobs, found):
+            if line.endswith(' missing'):
+                missing.append(file)
+            else:
+                executable = self.fileMode() and util.isExecutable(os.path.join(self.git_dir, file))
+                entries.append('%s %s\t%s\x00' % ('100755' if executable else '100644', sha, file))
+        if entries:
+            self._git_exec(['update-index', '--add', '-z', '--index-info'], input=''.join(entries))
+        return missing
+
+    def removeFiles(self, files):
+        '''
+        Remove many files with a single index update.
+        '''
+        if not files:
+            return
+        try:
+            self._git_exec(['rm', '-q', '-f', '--pathspec-from-file=-', '--pathspec-file-nul'], input='\x00'.join(files))
+        except Exception as e:
+            # Fall back to per-file removes (also for git before 2.25), which raise
+            # for the file that cannot be removed
+            logger.warning('Batch remove failed, removing files one by one: %s', str(e))
+            for file in files:
+                self.removeFile(file)
 
     def pullRebase(self):
         self._git_exec(['pull', '--rebase'])
-        recorder.debug('%s', formatRecord(None))
+        self.heads.clear()
 
     def push(self):
         self._git_exec(['push'])
-        recorder.debug('%s', formatRecord(None))
+        self.heads.clear()
 
     def commit(self, msg, env=None):
         self._git_exec(['commit', '-m', msg], env=env)
-        recorder.debug('%s', formatRecord(None, msg, env))
+        self.heads.clear()
 
     def setTag(self, tagname, ref=''):
         tag = ['tag', '-f', tagname]
         if ref != '': tag.append(ref)
         self._git_exec(tag)
-        recorder.debug('%s', formatRecord(None, tagname, ref))
+        self.heads.clear()
 
     def removeTag(self, tagname):
         self._git_exec(['tag', '-d', tagname])
-        recorder.debug('%s', formatRecord(None, tagname))
+        self.heads.clear()
 
-    def filesList(self):
-        res = self._git_exec(['ls-files']).strip().split('\n')
-        recorder.debug('%s', formatRecord(res))
+    def directories(self, ref):
+        '''
+        Return all directories in the tree of the given commit.
+        '''
+        res = self._git_exec(['ls-tree', '-r', '-d', '--name-only', '-z', ref]).split('\x00')
+        res = [dir for dir in res if dir]
         return res
 
+    def indexFiles(self):
+        '''
+        Yield the files in the index in git's (byte) order, as git ls-files -z lists them.
+        '''
+        return util.stream('git', ['ls-files', '-z'], self.git_dir, sep='\x00')
+
     def branchHead(self, branch='HEAD'):
-        res = self._git_exec(['show', '-s', '--format=%H', branch]).strip()
-        recorder.debug('%s', formatRecord(res, branch))
+        if branch not in self.heads:
+            self.heads[branch] = self._git_exec(['show', '-s', '--format=%H', branch]).strip()
+        res = self.heads[branch]
         return res
 
     def updateRemote(self):
         self._git_exec(['remote', 'update'])
-        recorder.debug('%s', formatRecord(None))
+        self.heads.clear()
 
     def commitMessage(self, commitId):
-        res = self._git_exec(['log', '--format=%B', '%s^..%s' % (commitId, commitId)]).strip()
-        recorder.debug('%s', formatRecord(res, commitId))
+        res = self._commitMetadata(commitId)['message']
         return res
 
     def commitDate(self, commitId):
-        dateStr = self._git_exec(['show', '-s', '--format=%ci', commitId])[:19]
-        res = datetime.strptime(dateStr, '%Y-%m-%d %H:%M:%S')
+        res = self._commitMetadata(commitId)['date']
         return res
 
     def authorName(self, commitId):
-        res = self._git_exec(['show', '-s', '--format=%an', commitId]).strip()
-        recorder.debug('%s', formatRecord(res, commitId))
+        res = self._commitMetadata(commitId)['name']
         return res
 
     def authorEmail(self, commitId):
-        res = self._git_exec(['show', '-s', '--format=%ae', commitId]).strip()
-        recorder.debug('%s', formatRecord(res, commitId))
+        res = self._commitMetadata(commitId)['email']
         return res
 
+    def loadCommits(self, commits):
+        '''
+        Load the metadata of the given commits into the cache, skipping those already loaded.
+        '''
+        commits = [cc for cc in commits if cc not in self.metadata]
+        for ii in range(0, len(commits), METADATA_CHUNK):
+            self._loadMetadata(['--no-walk'] + commits[ii:ii+METADATA_CHUNK])
+
+    def _commitMetadata(self, commitId):
+        if commitId not in self.metadata:
+            sha = commitId if re.match('^[0-9a-f]{40}$', commitId) else self.branchHead(commitId)
+            if sha not in self.metadata:
+                self._loadMetadata(['--no-walk', sha])
+            commitId = sha
+        return self.metadata[commitId]
+
+    def _loadMetadata(self, revs):
+        out = self._git_exec(['log', '-z', '--format=%s' % METADATA_FORMAT] + revs)
+        if out.endswith('\x00'):
+            out = out[:-1]
+        if out == '':
+            return
+        fields = out.split('\x00')
+        if len(fields) % METADATA_FIELDS != 0:
+            raise Exception('Unexpected commit metadata format for %s' % ' '.join(revs))
+        for ii in range(0, len(fields), METADATA_FIELDS):
+            sha, date, name, email, message = fields[ii:ii+METADATA_FIELDS]
+            self.metadata[sha] = {
+                'date': datetime.strptime(date[:19], '%Y-%m-%d %H:%M:%S'),
+                'name': name,
+                'email': email,
+                'message': message.strip(),
+            }
+
     def blob(self, commitId, file):
-        sha = self._git_exec(['ls-tree', commitId, file]).split(' ')[2].split('\t')[0]
-        blob = self._git_exec(['cat-file', 'blob', sha])
-        recorder.debug('%s', formatRecord(blob, commitId, file))
+        blob = self.blobReader.read('%s:%s' % (commitId, file))
         return blob
 
     def mergeCommitFf(self, commitId, msg):
         self._git_exec(['merge', '--ff', '--commit', '-m', msg, commitId])
-        recorder.debug('%s', formatRecord(None, commitId, msg))
+        self.heads.clear()
 
     def mergeCommitNoFf(self, commitId, msg):
         self._git_exec(['merge', '--no-ff', '--commit', '-m', msg, commitId])
-        recorder.debug('%s', formatRecord(None, commitId, msg))
+        self.heads.clear()
 
     def mergeAbort(self):
         self._git_exec(['merge', '--abort'])
-        recorder.debug('%s', formatRecord(None))
 
-    def commitHistoryPathBlob(self, fromRef, toRef):
-        # ivar: explore the need for x01 delimiters when using the -z flag
-        res = self._git_exec(['log', '-z', '--first-parent', '--reverse', '--format=%x01%H%x02%s%x02%b', '%s..%s' % (fromRef, toRef)]).strip('\x01')
-        recorder.debug('%s', formatRecord(res, fromRef, toRef))
+    def commitChanges(self, fromRef, toRef):
+        '''
+        Yield (commitId, subject, body, status) for each first-parent commit in the
+        range, oldest first, all from one streaming git log. status is the NUL separated
+        name-status (-M -z) of the commit against its first parent.
+        '''
+        cmd = ['log', '-z', '--first-parent', '-m', '--reverse', '--name-status', '-M', '--format=%x01%H%x02%s%x02%b%x02', '%s..%s' % (fromRef, toRef)]
+        pending = ''
+        for line in util.stream('git', cmd, self.git_dir):
+            pending += line
+            if '\x01' not in line:
+                continue
+            records = pending.split('\x01')
+            pending = records.pop()
+            for record in records:
+                if record:
+                    yield self._commitChange(record, fromRef, toRef)
+        if pending:
+            yield self._commitChange(pending, fromRef, toRef)
+
+    def _commitChange(self, record, fromRef, toRef):
+        commitId, subject, body, status = record.split('\x02', 3)
+        res = (commitId, subject, body, status.strip('\x00\n'))
         return res
 
     def reverseCommitHistoryList(self, fromRef, toRef='HEAD'):
@@ -148,7 +410,6 @@ class GitFacade(object):
         # ivar: why not use -z flag here?   
         commits = self._git_exec(['log', '--first-parent', '--reverse', '--format=%H', '%s..%s' % (fromRef, toRef)]).strip()
         res = commits.split('\n') if commits != '' else None
-        recorder.debug('%s', formatRecord(res, fromRef, toRef))
         return res
 
 
@@ -0,0 +1,116 @@
+'''
+Logging that never makes the bridge wait. A QueueHandler puts records on an
+unbounded queue, and a QueueListener thread formats and writes them to the real
+handlers, so a slow disk or mail relay only delays the log. Error mails are
+collected by a DigestMailHandler and sent as one mail per run (or daemon cycle)
+when the listener is flushed.
+'''
+import Queue
+import threading
+import logging
+import logging.handlers
+
+# Queue marker asking the listener to flush its handlers
+FLUSH = object()
+
+
+def _snapshot(arg):
+    if isinstance(arg, list):
+        return list(arg)
+    if isinstance(arg, dict):
+        return dict(arg)
+    if isinstance(arg, set):
+        return set(arg)
+    return arg
+
+
+class QueueHandler(logging.Handler):
+    '''
+    Puts records on a queue, unformatted. Mutable arguments are copied (shallowly)
+    so that the listener formats them as they were when logged.
+    '''
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+
+    def emit(self, record):
+        try:
+            if isinstance(record.args, tuple):
+                record.args = tuple([_snapshot(arg) for arg in record.args])
+            self.queue.put_nowait(record)
+        except Exception:
+            self.handleError(record)
+
+
+class QueueListener(object):
+    def __init__(self, queue, *handlers):
+        self.queue = queue
+        self.handlers = handlers
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._monitor)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def flush(self):
+        self.queue.put(FLUSH)
+
+    def stop(self):
+        '''
+        Write the queued records, flush the handlers and stop the listener thread.
+        '''
+        if self.thread:
+            self.queue.put(FLUSH)
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def _monitor(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                return
+            if record is FLUSH:
+                for handler in self.handlers:
+                    handler.flush()
+                continue
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+
+class DigestMailHandler(logging.handlers.SMTPHandler):
+    '''
+    Collects the records it is given and mails them as one digest when flushed.
+    '''
+    def __init__(self, mailhost, fromaddr, toaddrs, subject):
+        logging.handlers.SMTPHandler.__init__(self, mailhost, fromaddr, toaddrs, subject)
+        self.messages = []
+
+    def emit(self, record):
+        try:
+            self.messages.append(self.format(record))
+        except Exception:
+            self.handleError(record)
+
+    def getSubject(self, record):
+        return '%s (%d errors)' % (self.subject, record.count)
+
+    def flush(self):
+        if not self.messages:
+            return
+        digest = logging.makeLogRecord({'msg': '\n\n'.join(self.messages), 'levelno': logging.ERROR, 'levelname': 'ERROR'})
+        digest.count = len(self.messages)
+        self.messages = []
+        # Sent as is, the messages are formatted already
+        formatter = self.formatter
+        self.formatter = None
+        try:
+            logging.handlers.SMTPHandler.emit(self, digest)
+        finally:
+            self.formatter = formatter
+
+    def close(self):
+        self.flush()
+        logging.handlers.SMTPHandler.close(self)
@@ -0,0 +1,129 @@
+import json
+import threading
+import logging
+import os
+from datetime import datetime
+
+import timeline
+
+logger = logging.getLogger('log.bgcc.file')
+
+# Upper bounds (seconds) of the command duration histogram buckets
+BUCKETS = [0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0]
+
+
+class CommandStats(object):
+    '''
+    Aggregated wall time, exit codes and output size of one tool subcommand.
+    '''
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.buckets = [0] * len(BUCKETS)
+        self.bytes = 0
+        self.exitCodes = {}
+
+    def add(self, seconds, returncode, size):
+        self.count += 1
+        self.seconds += seconds
+        for ii, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[ii] += 1
+        self.bytes += size
+        self.exitCodes[returncode] = self.exitCodes.get(returncode, 0) + 1
+
+    def asDict(self):
+        return {
+            'count': self.count,
+            'seconds': self.seconds,
+            'buckets': dict(zip(map(str, BUCKETS), self.buckets)),
+            'bytes': self.bytes,
+            'exit_codes': dict([(str(kk), vv) for kk, vv in self.exitCodes.items()]),
+        }
+
+
+_lock = threading.Lock()
+_stats = {}
+_started = datetime.now()
+
+
+def record(tool, subcommand, seconds, returncode, size):
+    '''
+    Record one invocation of an external command, e.g. ('cleartool', 'get', ...).
+    '''
+    with _lock:
+        key = (tool, subcommand)
+        if key not in _stats:
+            _stats[key] = CommandStats()
+        _stats[key].add(seconds, returncode, size)
+    timeline.command(tool, subcommand, seconds, returncode, size)
+
+
+def reset():
+    with _lock:
+        _stats.clear()
+
+
+def snapshot():
+    '''
+    Return the metrics collected so far as a dictionary keyed by 'tool subcommand'.
+    '''
+    with _lock:
+        return dict([('%s %s' % key, st.asDict()) for key, st in _stats.items()])
+
+
+def subcommand(cmd):
+    '''
+    The subcommand of an argument list without the executable, e.g. 'get' for ['get', '-to', ...].
+    '''
+    for arg in cmd:
+        if not arg.startswith('-'):
+            return arg
+    return cmd[0] if cmd else ''
+
+
+def write(prefix):
+    '''
+    Write the metrics collected so far to <prefix>.json and, in the Prometheus
+    text format, to <prefix>.prom.
+    '''
+    with _lock:
+        stats = sorted(_stats.items())
+        data = {
+            'started': _started.strftime('%Y-%m-%d %H:%M:%S'),
+            'written': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'commands': dict([('%s %s' % key, st.asDict()) for key, st in stats]),
+        }
+        prom = [
+            '# HELP bgcc_command_duration_seconds Wall time of external commands run by the bridge.',
+            '# TYPE bgcc_command_duration_seconds histogram',
+        ]
+        for (tool, sub), st in stats:
+            labels = 'tool="%s",command="%s"' % (tool, sub)
+            for bound, count in zip(BUCKETS, st.buckets):
+                prom.append('bgcc_command_duration_seconds_bucket{%s,le="%s"} %d' % (labels, bound, count))
+            prom.append('bgcc_command_duration_seconds_bucket{%s,le="+Inf"} %d' % (labels, st.count))
+            prom.append('bgcc_command_duration_seconds_sum{%s} %f' % (labels, st.seconds))
+            prom.append('bgcc_command_duration_seconds_count{%s} %d' % (labels, st.count))
+        prom.append('# HELP bgcc_command_output_bytes_total Output size of external commands.')
+        prom.append('# TYPE bgcc_command_output_bytes_total counter')
+        for (tool, sub), st in stats:
+            prom.append('bgcc_command_output_bytes_total{tool="%s",command="%s"} %d' % (tool, sub, st.bytes))
+        prom.append('# HELP bgcc_command_exit_total Exit codes of external commands.')
+        prom.append('# TYPE bgcc_command_exit_total counter')
+        for (tool, sub), st in stats:
+            for code, count in sorted(st.exitCodes.items()):
+                prom.append('bgcc_command_exit_total{tool="%s",command="%s",code="%s"} %d' % (tool, sub, code, count))
+    _writeFile(prefix + '.json', json.dumps(data, indent=2, sort_keys=True))
+    _writeFile(prefix + '.prom', '\n'.join(prom) + '\n')
+
+
+def _writeFile(path, content):
+    # Write aside and rename, so collectors never read a half written file
+    tmp = path + '.tmp'
+    ff = open(tmp, 'w')
+    ff.write(content)
+    ff.close()
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(tmp, path)
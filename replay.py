@@ -0,0 +1,199 @@
+'''
+Record and replay of a bridge run. Recording wraps the git and clearcase
+facades, the VOB fetcher and the file system probes (util.FileSystem) of a
+running bridge in proxies that log every call with its arguments and result.
+Replaying installs proxies that answer the same calls from the recording in
+memory, without running cleartool or git, so that the bridge logic itself can
+be profiled.
+
+The bridge state files under .git (the state database and the version index) are
+saved with the recording and restored to a temporary directory on replay.
+'''
+import os
+import cPickle as pickle
+import tempfile
+import types
+import threading
+import logging
+from collections import deque
+
+import bridge
+from clearcase import CheckinHistory
+from state import BridgeState
+from git import FastImport
+
+logger = logging.getLogger('log.bgcc.file')
+
+# Facade attributes read directly by the bridge
+ATTRIBUTES = {
+    'git': ['git_dir'],
+    'cc': ['cc_dir', 'includes', 'branches'],
+    'fetcher': [],
+    'fs': [],
+}
+
+
+class ReplayMismatch(Exception):
+    pass
+
+
+def _normalize(value):
+    '''
+    Make call arguments comparable between runs. Dictionaries (e.g. the commit
+    environment) are reduced to their sorted GIT_ entries.
+    '''
+    if isinstance(value, (list, tuple)):
+        return tuple(map(_normalize, value))
+    if hasattr(value, 'keys'):
+        return tuple(sorted([(kk, value[kk]) for kk in value.keys() if str(kk).startswith('GIT_')]))
+    return value
+
+
+def _key(target, method, args, kwargs):
+    return repr((target, method, _normalize(args), _normalize(sorted(kwargs.items()))))
+
+
+class Recording(object):
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.lock = threading.Lock()
+
+    def write(self, record):
+        with self.lock:
+            pickle.dump(record, self.file, pickle.HIGHEST_PROTOCOL)
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class RecordingProxy(object):
+    '''
+    Forwards calls to the target and records them. Checkin histories are recorded
+    as their event lines (newest first, as cleartool lists them), generators as
+    the list of what they yield, and fast-import sessions get a proxy of their own.
+    '''
+    def __init__(self, name, target, recording):
+        self._name = name
+        self._target = target
+        self._recording = recording
+
+    def __getattr__(self, attr):
+        value = getattr(self._target, attr)
+        if not callable(value):
+            return value
+        def call(*args, **kwargs):
+            key = _key(self._name, attr, args, kwargs)
+            try:
+                result = value(*args, **kwargs)
+            except Exception as e:
+                self._recording.write((key, self._name, attr, None, str(e)))
+                raise
+            recorded = result
+            if isinstance(result, CheckinHistory):
+                recorded = ('history', list(reversed(map(str, result))))
+            elif isinstance(result, types.GeneratorType):
+                result = recorded = list(result)
+            elif isinstance(result, FastImport):
+                recorded = ('fastimport', None)
+                result = RecordingProxy('fastimport', result, self._recording)
+            self._recording.write((key, self._name, attr, recorded, None))
+            return result
+        return call
+
+
+class ReplayProxy(object):
+    '''
+    Answers calls from the recorded results for the same target, method and
+    arguments, in recorded order. Calls that were not recorded with the same
+    arguments take the next result of the same method if that method only ever
+    returned None (e.g. commands run with temporary file names), and raise
+    ReplayMismatch otherwise.
+    '''
+    def __init__(self, name, attributes, calls, methods):
+        self._name = name
+        self._attributes = attributes
+        self._calls = calls
+        self._methods = methods
+
+    def __getattr__(self, attr):
+        if attr in self._attributes:
+            return self._attributes[attr]
+        def call(*args, **kwargs):
+            queue = self._calls.get(_key(self._name, attr, args, kwargs))
+            if not queue:
+                results = self._methods.get((self._name, attr))
+                if results is not None and results['others']:
+                    raise ReplayMismatch('%s.%s%s was not recorded' % (self._name, attr, str(args)[:200]))
+                logger.debug('Replaying unrecorded call %s.%s as None', self._name, attr)
+                return None
+            result, error = queue.popleft()
+            if error is not None:
+                raise Exception(error)
+            if isinstance(result, tuple) and len(result) == 2 and result[0] == 'history':
+                return CheckinHistory(result[1])
+            if isinstance(result, tuple) and len(result) == 2 and result[0] == 'fastimport':
+                return ReplayProxy('fastimport', {}, self._calls, self._methods)
+            return result
+        return call
+
+
+def _stateFiles(bb):
+    return {
+        'state': bb.state_path,
+        'vob_index': bb.vobindex.path,
+    }
+
+
+def record(bb, path):
+    '''
+    Start recording the run of bridge bb to path.
+    '''
+    recording = Recording(path)
+    state = {}
+    for name, file in _stateFiles(bb).items():
+        if os.path.exists(file):
+            ff = open(file, 'rb')
+            state[name] = ff.read()
+            ff.close()
+    attributes = {}
+    for name in ATTRIBUTES:
+        target = getattr(bridge, name)
+        attributes[name] = dict([(attr, getattr(target, attr)) for attr in ATTRIBUTES[name]])
+        setattr(bridge, name, RecordingProxy(name, target, recording))
+    recording.write({'attributes': attributes, 'state': state})
+    logger.info('Recording bridge run to %s', path)
+    return recording
+
+
+def replay(bb, path):
+    '''
+    Make bridge bb answer all facade and file system calls from the recording at path.
+    '''
+    ff = open(path, 'rb')
+    header = pickle.load(ff)
+    calls = {}
+    methods = {}
+    while True:
+        try:
+            key, name, method, result, error = pickle.load(ff)
+        except EOFError:
+            break
+        calls.setdefault(key, deque()).append((result, error))
+        results = methods.setdefault((name, method), {'others': False})
+        results['others'] = results['others'] or result is not None or error is not None
+    ff.close()
+    statedir = tempfile.mkdtemp(prefix='bgcc-replay-')
+    bb.commit_cache = os.path.join(statedir, 'commit_cache')
+    bb.state_path = os.path.join(statedir, 'state')
+    bb.vobindex.path = os.path.join(statedir, 'vob_index')
+    for name, content in header['state'].items():
+        ff = open(os.path.join(statedir, name), 'wb')
+        ff.write(content)
+        ff.close()
+    bb.vobindex.__init__(bb.vobindex.path)
+    bridge.store.close()
+    bridge.store = BridgeState(bb.state_path)
+    for name in ATTRIBUTES:
+        setattr(bridge, name, ReplayProxy(name, header['attributes'][name], calls, methods))
+    logger.info('Replaying bridge run from %s (%d calls)', path, sum(map(len, calls.values())))
@@ -0,0 +1,164 @@
+'''
+Durable bridge state, kept in an SQLite database under .git. It holds the git
+commits pending checkin to clearcase with the checkin state of each, the cc
+branch commit a checkin batch started from, and the watermark of the clearcase
+history imported (see clearcase.Watermark). Every change is made in a
+transaction, so that a bridge run that dies half way leaves a state the next run
+can resume from.
+
+A pending commit goes through the states
+    pending    -> waiting to be merged on the cc branch
+    merged     -> merged on the cc branch as cc_commit
+    checkingin -> files of cc_commit are being checked out/in
+    checkedin  -> cc_commit is checked in to clearcase
+
+The commit whose checkin was interrupted is remembered until the batch that
+checks it in again finishes.
+'''
+import sqlite3
+import logging
+from datetime import datetime
+
+logger = logging.getLogger('log.bgcc.file')
+
+PENDING = 'pending'
+MERGED = 'merged'
+CHECKINGIN = 'checkingin'
+CHECKEDIN = 'checkedin'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS commits (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    commit_id TEXT NOT NULL,
+    cc_commit TEXT,
+    state TEXT NOT NULL,
+    updated TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+'''
+
+
+class BridgeState(object):
+    def __init__(self, path):
+        self.path = path
+        self.connection = None
+
+    @property
+    def db(self):
+        # Opened on first use, since a new bridge has no .git directory before
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path)
+            self.connection.text_factory = str
+            self.connection.executescript(SCHEMA)
+        return self.connection
+
+    def close(self):
+        if self.connection:
+            self.connection.close()
+            self.connection = None
+
+    def pendingCommits(self):
+        '''
+        The commits not yet merged on the cc branch, in the order they were created.
+        '''
+        rows = self.db.execute('SELECT commit_id FROM commits WHERE state = ? ORDER BY seq', (PENDING,))
+        return [row[0] for row in rows]
+
+    def setPendingCommits(self, commits):
+        with self.db:
+            self.db.execute('DELETE FROM commits WHERE state = ?', (PENDING,))
+            self.db.executemany('INSERT INTO commits (commit_id, state, updated) VALUES (?, ?, ?)',
+                [(commitId, PENDING, _now()) for commitId in commits])
+
+    def checkinBase(self):
+        '''
+        The cc branch commit the unfinished checkin batch started from, or None.
+        '''
+        return self._get('checkin_base')
+
+    def beginCheckin(self, base):
+        with self.db:
+            self._set('checkin_base', base)
+
+    def setMerged(self, commitId, ccCommit):
+        '''
+        Record that commitId was merged on the cc branch as ccCommit. A commit the
+        branch already contained has nothing left to check in.
+        '''
+        state = CHECKEDIN if ccCommit is None else MERGED
+        with self.db:
+            self.db.execute('UPDATE commits SET cc_commit = ?, state = ?, updated = ? WHERE seq = (SELECT min(seq) FROM commits WHERE commit_id = ? AND state = ?)',
+                (ccCommit, state, _now(), commitId, PENDING))
+
+    def setCheckinState(self, ccCommit, state):
+        with self.db:
+            self.db.execute('UPDATE commits SET state = ?, updated = ? WHERE cc_commit = ?', (state, _now(), ccCommit))
+
+    def unfinishedCheckins(self):
+        '''
+        The (commit_id, cc_commit, state) of merged commits not yet checked in, in order.
+        '''
+        rows = self.db.execute('SELECT commit_id, cc_commit, state FROM commits WHERE state IN (?, ?) ORDER BY seq', (MERGED, CHECKINGIN))
+        return rows.fetchall()
+
+    def lastCheckedIn(self):
+        '''
+        The last cc branch commit checked in to clearcase in the unfinished batch,
+        or the commit the batch started from.
+        '''
+        row = self.db.execute('SELECT cc_commit FROM commits WHERE state = ? AND cc_commit IS NOT NULL ORDER BY seq DESC LIMIT 1', (CHECKEDIN,)).fetchone()
+        return row[0] if row else self.checkinBase()
+
+    def rewindCheckin(self, interrupted=None):
+        '''
+        Forget the merges of commits not checked in, making them pending again
+        ahead of the commits pulled since, and drop the checked in ones. Give the
+        commit_id of a commit whose checkin was interrupted to remember it.
+        '''
+        with self.db:
+            if interrupted:
+                self._set('interrupted', interrupted)
+            self.db.execute('DELETE FROM commits WHERE state = ?', (CHECKEDIN,))
+            self.db.execute('UPDATE commits SET cc_commit = NULL, state = ?, updated = ? WHERE state IN (?, ?)', (PENDING, _now(), MERGED, CHECKINGIN))
+            self._set('checkin_base', None)
+
+    def finishCheckin(self):
+        with self.db:
+            self.db.execute('DELETE FROM commits WHERE state = ?', (CHECKEDIN,))
+            self._set('checkin_base', None)
+            self._set('interrupted', None)
+
+    def isInterruptedCheckin(self, ccCommit):
+        '''
+        Whether ccCommit is the merge of the commit whose checkin was interrupted.
+        '''
+        interrupted = self._get('interrupted')
+        row = self.db.execute('SELECT 1 FROM commits WHERE cc_commit = ? AND commit_id = ?', (ccCommit, interrupted)).fetchone()
+        return row is not None
+
+    def watermark(self):
+        '''
+        The clearcase history watermark up to which checkin events are in git.
+        '''
+        return self._get('watermark')
+
+    def setWatermark(self, watermark):
+        with self.db:
+            self._set('watermark', watermark)
+
+    def _get(self, key):
+        row = self.db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set(self, key, value):
+        if value is None:
+            self.db.execute('DELETE FROM meta WHERE key = ?', (key,))
+        else:
+            self.db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+
+def _now():
+    return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
@@ -0,0 +1,153 @@
+'''
+Timeline of a bridge run in the Chrome trace-event format, to be opened in
+chrome://tracing or https://ui.perfetto.dev. The bridge marks its phases (see
+phase), and every external command is added as it finishes (from
+metrics.record), so commands show nested under the phase that ran them, per
+thread. With profiling, the outermost phases also run under cProfile and carry
+the functions that took the most time in their arguments.
+
+Nothing is recorded unless the timeline was started, e.g. by bridgerunner --profile.
+'''
+import os
+import json
+import time
+import threading
+import cProfile
+from functools import wraps
+
+# Functions listed per profiled phase
+PROFILE_TOP = 15
+
+_lock = threading.Lock()
+_local = threading.local()
+_events = []
+_threads = {}
+_started = None
+_profiling = False
+
+
+def start(profile=False):
+    '''
+    Start recording, with cProfile for the outermost phases if profile is set.
+    '''
+    global _started, _profiling
+    with _lock:
+        del _events[:]
+        _threads.clear()
+        _started = time.time()
+        _profiling = profile
+
+
+def clear():
+    '''
+    Drop the events recorded so far, e.g. after writing those of a daemon cycle.
+    '''
+    with _lock:
+        del _events[:]
+
+
+def _thread():
+    thread = threading.current_thread()
+    tid = thread.ident
+    if tid not in _threads:
+        _threads[tid] = thread.name
+    return tid
+
+
+def _add(name, category, start, seconds, args):
+    with _lock:
+        if _started is None:
+            return
+        _events.append({
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': int((start - _started) * 1000000),
+            'dur': int(seconds * 1000000),
+            'pid': os.getpid(),
+            'tid': _thread(),
+            'args': args,
+        })
+
+
+def command(tool, subcommand, seconds, returncode, size):
+    '''
+    Add an external command that just finished after running for seconds.
+    '''
+    if _started is not None:
+        _add('%s %s' % (tool, subcommand), tool, time.time() - seconds, seconds, {'exit': returncode, 'bytes': size})
+
+
+class phase(object):
+    '''
+    Marks a phase of the bridge, as a context manager or a method decorator:
+
+        with timeline.phase('commitToGit', comment=comment):
+            ...
+
+        @timeline.phase('syncReport')
+        def syncReport(self):
+    '''
+    def __init__(self, name, **args):
+        self.name = name
+        self.args = args
+
+    def __call__(self, func):
+        @wraps(func)
+        def traced(*args, **kwargs):
+            with phase(self.name, **self.args):
+                return func(*args, **kwargs)
+        return traced
+
+    def __enter__(self):
+        if _started is None:
+            return self
+        self.profiler = None
+        depth = getattr(_local, 'depth', 0)
+        _local.depth = depth + 1
+        # cProfile keeps one profiler per thread, so only the outermost phase profiles
+        if _profiling and depth == 0:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, type, value, tb):
+        if _started is None or not hasattr(self, 'start'):
+            return False
+        seconds = time.time() - self.start
+        _local.depth -= 1
+        args = dict(self.args)
+        if type is not None:
+            args['error'] = str(value)[:200]
+        if self.profiler:
+            self.profiler.disable()
+            args['profile'] = _topFunctions(self.profiler)
+        _add(self.name, 'phase', self.start, seconds, args)
+        return False
+
+
+def _topFunctions(profiler):
+    '''
+    The functions with the most time spent in them, as 'seconds calls file:line(function)'.
+    '''
+    profiler.create_stats()
+    rows = sorted(profiler.stats.items(), key=lambda item: item[1][2], reverse=True)[:PROFILE_TOP]
+    return ['%.3fs %d %s:%d(%s)' % (tottime, calls, os.path.basename(file), line, func)
+            for (file, line, func), (cc, calls, tottime, cumtime, callers) in rows]
+
+
+def write(path):
+    '''
+    Write the events recorded so far to path as a trace-event JSON file.
+    '''
+    with _lock:
+        events = list(_events)
+        threads = dict(_threads)
+    pid = os.getpid()
+    meta = [{'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': 0, 'args': {'name': 'bgcc bridge'}}]
+    for tid, name in sorted(threads.items()):
+        meta.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}})
+    ff = open(path, 'w')
+    json.dump({'traceEvents': meta + sorted(events, key=lambda ev: ev['ts']), 'displayTimeUnit': 'ms'}, ff)
+    ff.close()
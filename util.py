@@ -4,8 +4,11 @@ from subprocess import Popen, PIPE
 from os.path import join, dirname, exists
 from ConfigParser import SafeConfigParser
 import inspect
+import tempfile
 import logging
+import time
 from datetime import datetime
+import metrics
 
 logger = logging.getLogger('log.bgcc.file')
 
@@ -40,10 +43,81 @@ class GitConfigParser():
         return ccroot
     def logFile(self):
         return self.parser.get('core', 'log_file')
+    def ccSession(self):
+        if self.parser.has_option('core', 'cc_session'):
+            return self.parser.getboolean('core', 'cc_session')
+        return False
+    def fastImport(self):
+        if self.parser.has_option('core', 'fast_import'):
+            return self.parser.getboolean('core', 'fast_import')
+        return False
     def remote(self):
         if self.parser.has_option('core', 'remote'):
             return self.parser.get('core', 'remote')
         return None
+    def fetchWorkers(self):
+        if self.parser.has_option('core', 'fetch_workers'):
+            return self.parser.getint('core', 'fetch_workers')
+        return 4
+    def checkinWorkers(self):
+        if self.parser.has_option('core', 'checkin_workers'):
+            return self.parser.getint('core', 'checkin_workers')
+        return 1
+    def updateScope(self):
+        '''
+        What an update of the view covers: the stale 'paths', the 'include' folders,
+        or the whole 'view'.
+        '''
+        if self.parser.has_option('core', 'update_scope'):
+            scope = self.parser.get('core', 'update_scope')
+            if scope not in ('paths', 'include', 'view'):
+                raise Exception('Unknown update_scope: %s (expected paths, include or view)' % scope)
+            return scope
+        return 'paths'
+    def fullRescanHours(self):
+        if self.parser.has_option('core', 'full_rescan_hours'):
+            return self.parser.getint('core', 'full_rescan_hours')
+        return 24
+    def pollInterval(self):
+        '''
+        Minimum and maximum seconds between polls in daemon mode.
+        '''
+        minInterval = maxInterval = None
+        if self.parser.has_option('core', 'poll_min'):
+            minInterval = self.parser.getint('core', 'poll_min')
+        if self.parser.has_option('core', 'poll_max'):
+            maxInterval = self.parser.getint('core', 'poll_max')
+        minInterval = minInterval or 60
+        return (minInterval, max(minInterval, maxInterval or 900))
+    def metricsFile(self):
+        '''
+        Path prefix for the .json and .prom command metrics files, if any.
+        '''
+        if self.parser.has_option('core', 'metrics_file'):
+            return self.parser.get('core', 'metrics_file')
+        return None
+    def blobCache(self):
+        '''
+        Directory of the blob cache of fetched element versions, if any. It may be
+        shared by the bridges on a host.
+        '''
+        if self.parser.has_option('core', 'blob_cache'):
+            return self.parser.get('core', 'blob_cache')
+        return None
+    def blobCacheSize(self):
+        '''
+        Size limit of the blob cache in megabytes.
+        '''
+        if self.parser.has_option('core', 'blob_cache_mb'):
+            return self.parser.getint('core', 'blob_cache_mb')
+        return 1024
+    def blobCacheScope(self):
+        '''
+        Name under which versions are shared in the blob cache, cc_root by default.
+        '''
+        if self.parser.has_option('core', 'blob_cache_scope'):
+            return self.parser.get('core', 'blob_cache_scope')
+        return self.ccRoot()
     def getInclude(self):
         return self.parser.get('core', 'include').split('|')
     def getBranches(self):
@@ -56,6 +130,27 @@ class GitConfigParser():
         return self.parser.get('email', 'smtp')
 
 
+class FileSystem(object):
+    '''
+    The file system probes and writes that steer the bridge logic (mainly the
+    Diff classes checking for existing directories in the view), kept behind one
+    object so that they can be recorded and replayed along with the facades.
+    '''
+    def exists(self, path):
+        return os.path.exists(path)
+
+    def writeFile(self, path, data):
+        ff = open(path, 'wb')
+        ff.write(data)
+        ff.close()
+
+    def remove(self, path):
+        os.remove(path)
+
+    def prepareForCopy(self, path):
+        prepareForCopy(path)
+
+
 def prepareForCopy(filepath):
     if os.path.exists(filepath):
         os.remove(filepath)
@@ -66,17 +161,81 @@ def prepareForCopy(filepath):
             pass # The directory already exists
 
 
-def popen(exe, cmd, cwd, env=None, decode=True, errors=True):
+def popen(exe, cmd, cwd, env=None, decode=True, errors=True, input=None):
     cmd.insert(0, exe)
     f = lambda a: a if not a.count(' ') else '"%s"' % a
     logger.log(logging.DEBUG-5, ' '.join(map(f, cmd)))
-    pipe = Popen(cmd, cwd=cwd, stdout=PIPE, stderr=PIPE, env=env)
-    (stdout, stderr) = pipe.communicate()
+    stdin = PIPE if input is not None else None
+    start = time.time()
+    pipe = Popen(cmd, cwd=cwd, stdin=stdin, stdout=PIPE, stderr=PIPE, env=env)
+    (stdout, stderr) = pipe.communicate(input)
+    metrics.record(exe, metrics.subcommand(cmd[1:]), time.time() - start, pipe.returncode, len(stdout))
     if errors and pipe.returncode > 0:
         raise Exception((stderr + stdout))
     return stdout if not decode else stdout
 
 
+def stream(exe, cmd, cwd, env=None, sep=None):
+    '''
+    Like popen, but yields stdout line by line as the process prints it. stderr is
+    spooled to a temporary file and raised with if the process fails. With sep, the
+    output is split on sep instead (e.g. NUL for -z output), without the separator.
+    '''
+    cmd.insert(0, exe)
+    f = lambda a: a if not a.count(' ') else '"%s"' % a
+    logger.log(logging.DEBUG-5, ' '.join(map(f, cmd)))
+    err = tempfile.TemporaryFile()
+    start = time.time()
+    size = 0
+    pipe = Popen(cmd, cwd=cwd, stdout=PIPE, stderr=err, env=env)
+    try:
+        chunks = iter(pipe.stdout.readline, '') if sep is None else _split(pipe.stdout, sep)
+        for line in chunks:
+            size += len(line)
+            yield line
+    except GeneratorExit:
+        # The consumer stopped reading early, the rest of the output is not wanted
+        if pipe.poll() is None:
+            pipe.kill()
+        raise
+    finally:
+        pipe.stdout.close()
+        pipe.wait()
+        metrics.record(exe, metrics.subcommand(cmd[1:]), time.time() - start, pipe.returncode, size)
+        err.seek(0)
+        stderr = err.read()
+        err.close()
+    # Only reached at the end of the output, where any exit code but 0 is a failure
+    if pipe.returncode != 0:
+        raise Exception(stderr or '%s exited with %d' % (exe, pipe.returncode))
+
+
+def _split(ff, sep, size=64*1024):
+    pending = ''
+    for chunk in iter(lambda: ff.read(size), ''):
+        parts = (pending + chunk).split(sep)
+        pending = parts.pop()
+        for part in parts:
+            yield part
+    if pending:
+        yield pending
+
+
+def spawn(exe, cmd, cwd, env=None, stderr=None):
+    '''
+    Start a long-lived process with piped stdin and stdout, for tools that are
+    fed commands one at a time (e.g. 'git cat-file --batch').
+    '''
+    cmd.insert(0, exe)
+    f = lambda a: a if not a.count(' ') else '"%s"' % a
+    logger.log(logging.DEBUG-5, ' '.join(map(f, cmd)))
+    return Popen(cmd, cwd=cwd, stdin=PIPE, stdout=PIPE, stderr=stderr, env=env)
+
+
+def isExecutable(path):
+    return os.stat(path).st_mode & 0111 != 0
+
+
 def timeDiff(t1, t2):
     # The assumption is that t2 > t1
     t1 = datetime.strptime(t1, '%Y%m%d.%H%M%S')